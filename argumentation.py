@@ -1,5 +1,5 @@
-from typing import Set, Any, Union, Dict
-from collections import OrderedDict
+from typing import Set, Any, Union, Dict, List, Tuple
+from collections import OrderedDict, defaultdict
 import english
 import parser
 from copy import copy
@@ -12,6 +12,11 @@ class Argument(object):
     """
     An argument exists of claims and attack or support relations between those
     claims, and between the relations themselves.
+
+    Arguments are values: their tables are never changed once they are made.
+    That lets combined arguments share the tables (and whole arguments) of
+    the ones they were made from whenever nothing changes, which is often,
+    as most grammar callbacks add a mostly empty argument to another one.
     """
     def __init__(self,
         claims: Dict['Claim', Set['Claim']] = {},
@@ -32,6 +37,13 @@ class Argument(object):
         self.relations = relations
         self.instances = instances
 
+        # Reverse indexes from each occurrence to its claim or instance,
+        # built on first use. The tables are never changed after this, so
+        # they stay valid, and they are passed on to derived arguments that
+        # share the same tables.
+        self.__claim_index = None
+        self.__instance_index = None
+
         # Don't assert whether all instances are already are available, because in some cases this isn't yet true:
         # e.g. when adding a new overall claim, this argument is part of an interpretation that still has to be 
         # merged with other interpretations that carry the information about the instance!
@@ -47,20 +59,29 @@ class Argument(object):
     def __add__(self, other):
         """Combine two Arguments into one."""
         assert isinstance(other, self.__class__)
+
+        # Nothing to add, so nothing would change
+        if not other.claims and not other.relations and not other.instances:
+            return self
         
         instances = self.__merge_instances(other)
         # assert len(instances) >= max(len(self.instances), len(other.instances))
 
-        claims = self.__merge_claims(other, self.__class__(instances=instances))
+        context = self.__class__(instances=instances)
+        if instances is self.instances or instances is other.instances:
+            context.__instance_index = self.__shared_index(other, instances)
+        claims = self.__merge_claims(other, context)
         assert len(claims) >= max(len(self.claims), len(other.claims))
         
         relations = self.__merge_relations(other)
 
+        claim_index = self.__shared_index(other, claims)
+
         for claim in self.claims.keys():
-            assert self.__find_occurrence(claims, claim) is not None
+            assert claim in claim_index
 
         for claim in other.claims.keys():
-            assert self.__find_occurrence(claims, claim) is not None
+            assert claim in claim_index
 
         # This assertion does not hold: sometimes we only merge with this information
         # later on
@@ -68,13 +89,19 @@ class Argument(object):
         #    assert self.__find_occurrence(instances, claim.subject) is not None
 
         argument = self.__class__(claims, relations, instances)
+        argument.__claim_index = claim_index
+        argument.__instance_index = context.__instance_index
         
         # If one of the incoming claims is the negation of one of our own claims
         # we need to add an (assumed?) attack relation between the two!
+        # Only claims with the same scope and verb can be, so only those are
+        # looked at.
+        signatures = claim_signatures(claims.keys())
+        attacks = set()
         for a in other.claims:
             a_subj = argument.find_instance(a.subject)
             if a_subj is not None:
-                for b in claims.keys():
+                for b in signatures.get((a.scope, a.verb), ()):
                     if a.scope == b.scope \
                         and a.object.__class__.__name__ == 'Negation' \
                         and a.subject.__class__.__name__.endswith('Instance') \
@@ -82,8 +109,12 @@ class Argument(object):
                         and a_subj == argument.find_instance(b.subject) \
                         and a.verb == b.verb \
                         and a.object.object == b.object:
-                        argument.relations.add(Relation(sources={a}, target=b, type=Relation.ATTACK, assumption=True))
-                        argument.relations.add(Relation(sources={b}, target=a, type=Relation.ATTACK, assumption=True))
+                        attacks.add(Relation(sources={a}, target=b, type=Relation.ATTACK, assumption=True))
+                        attacks.add(Relation(sources={b}, target=a, type=Relation.ATTACK, assumption=True))
+
+        # The relations may be shared with self or other, so add to a copy
+        if attacks:
+            argument.relations = relations | attacks
         
         return argument
 
@@ -107,7 +138,9 @@ class Argument(object):
         for claim, occurrences in self.claims.items():
             scoped_claim = claim.update(scope=scope)
             claims[scoped_claim] = {scoped_claim} | occurrences
-        return self.__class__(claims, self.relations, self.instances)
+        argument = self.__class__(claims, self.relations, self.instances)
+        argument.__instance_index = self.__instance_index
+        return argument
 
     def find_claim(self, claim: 'Claim') -> 'Claim':
         return self.__find_occurrence(self.claims, claim)
@@ -116,11 +149,7 @@ class Argument(object):
         return self.__get_occurrence(self.claims, claim)
 
     def find_instance(self, instance: 'Instance') -> 'Instance':
-        assert instance is not None
-        for full_instance, occurrences in self.instances.items():
-            if instance in occurrences.keys():
-                return full_instance
-        return None
+        return self.__find_occurrence(self.instances, instance)
 
     def get_instance(self, instance: 'Instance') -> 'Instance':
         found = self.find_instance(instance)
@@ -129,14 +158,27 @@ class Argument(object):
         return found
 
     def __merge_instances(self, other: 'Argument') -> Dict['Instance', Set['Instance']]:
+        # If either has no instances, the merge is the other's (reversed, as
+        # below, which only matters when there is more than one).
+        if not other.instances:
+            return self.instances
+        if not self.instances and len(other.instances) == 1:
+            return other.instances
+
         # Merge the instances of this and the other Interpretation
         instances = OrderedDict(self.instances)
+
+        # Only the known instances that share a coreference key with the
+        # other instance could be the same, so those are the only ones that
+        # are compared, in the order they have in instances.
+        candidates = CoreferenceIndex(instances.keys())
+
         for other_instance, other_occurrences in reversed(list(other.instances.items())):
             merged = False
 
             # Check for all known instances whether they could be the same as
             # the other Interpretation's instance
-            for instance in instances.keys():
+            for instance in candidates.lookup(other_instance):
                 # If that is the case, update our instance and add the other's
                 # instance to the list of occurrences
                 could_be = instance.could_be(other_instance)
@@ -145,21 +187,37 @@ class Argument(object):
                     merged_instance = instance.replace(other_instance)
                     instances[merged_instance] = {**instances[instance], merged_instance:could_be, **other_occurrences}
                     del instances[instance]
+                    candidates.remove(instance)
+                    candidates.add(merged_instance)
                     merged = True
                     break
 
             # if it is new, just copy it to our table
             if not merged:
                 instances[other_instance] = other_occurrences
+                candidates.add(other_instance)
         return instances
 
     def __merge_claims(self, other: 'Argument', context: 'Argument') -> Dict['Claim', Set['Claim']]:
+        if not other.claims:
+            return self.claims
+        if not self.claims:
+            return other.claims
+
         claims = OrderedDict()
         matched = set()
 
+        # A claim can only be the same as one with the same id, or with the
+        # same scope and verb, see Claim.is_same.
+        order = {claim: n for n, claim in enumerate(self.claims.keys())}
+        signatures = claim_signatures(self.claims.keys())
+        ids = defaultdict(list)
+        for claim in self.claims.keys():
+            ids[claim.id].append(claim)
+
         for other_claim in other.claims.keys():
             merged = False
-            for claim in self.claims.keys():
+            for claim in sorted({*ids.get(other_claim.id, ()), *signatures.get((other_claim.scope, other_claim.verb), ())}, key=order.get):
                 if claim.is_same(other_claim, context):
                     key = claim if claim.is_preferred_over(other_claim, context) else other_claim
                     claims[key] = self.claims[claim] | other.claims[other_claim]
@@ -176,6 +234,11 @@ class Argument(object):
         return claims
 
     def __merge_relations(self, other: 'Argument') -> Set['Relation']:
+        if not other.relations:
+            return self.relations
+        if not self.relations:
+            return other.relations
+
         relations = set()
         other_merged = set()
 
@@ -197,10 +260,23 @@ class Argument(object):
 
     def __find_occurrence(self, instances, instance):
         assert instance is not None
-        for full_instance, occurrences in instances.items():
-            if instance in occurrences:
-                return full_instance
-        return None
+        return self.__index(instances).get(instance)
+
+    def __index(self, table):
+        """The occurrence index of one of our tables, or of another table."""
+        if table is self.claims:
+            if self.__claim_index is None:
+                self.__claim_index = occurrence_index(self.claims)
+            return self.__claim_index
+        if table is self.instances:
+            if self.__instance_index is None:
+                self.__instance_index = occurrence_index(self.instances)
+            return self.__instance_index
+        return occurrence_index(table)
+
+    def __shared_index(self, other: 'Argument', table):
+        """The occurrence index of a merged table, which may be ours or other's."""
+        return other.__index(table) if table is other.claims or table is other.instances else self.__index(table)
 
     def __get_occurrence(self, instances, instance):
         found = self.__find_occurrence(instances, instance)
@@ -209,6 +285,69 @@ class Argument(object):
         return found
 
 
+def occurrence_index(table: Dict[Any, Any]) -> Dict[Any, Any]:
+    """
+    Maps every occurrence in a table of claims or instances to the entry it is
+    an occurrence of. If it occurs in several, the first one wins, just like
+    when searching the table from the start.
+    """
+    index = dict()
+    for full_instance, occurrences in table.items():
+        for occurrence in occurrences:
+            index.setdefault(occurrence, full_instance)
+    return index
+
+
+def claim_signatures(claims) -> Dict[Tuple[Any, Any], List['Claim']]:
+    """
+    Groups claims by their scope and verb, keeping their order.
+    """
+    signatures = defaultdict(list)
+    for claim in claims:
+        signatures[claim.scope, claim.verb].append(claim)
+    return signatures
+
+
+class CoreferenceIndex(object):
+    """
+    Finds the instances that could be the same as another instance, without
+    asking each of them. Instances file themselves under the keys of
+    coreference_candidates(), and are found by the keys of the other
+    instance's coreference_keys(). Instances that do not have these are
+    always found, and always find everything. lookup() returns the
+    instances in the order they were added.
+    """
+    def __init__(self, instances):
+        self.order = dict()
+        self.added = 0
+        self.buckets = defaultdict(list)
+        self.everywhere = []
+        for instance in instances:
+            self.add(instance)
+
+    def add(self, instance) -> None:
+        if instance in self.order:
+            return
+        self.order[instance] = self.added
+        self.added += 1
+        if hasattr(instance, 'coreference_candidates'):
+            for key in instance.coreference_candidates():
+                self.buckets[key].append(instance)
+        else:
+            self.everywhere.append(instance)
+
+    def remove(self, instance) -> None:
+        del self.order[instance]
+
+    def lookup(self, other) -> List[Any]:
+        if not hasattr(other, 'coreference_keys'):
+            found = set(self.order.keys())
+        else:
+            found = {instance for key in other.coreference_keys() for instance in self.buckets.get(key, ())}
+            found.update(self.everywhere)
+        return sorted((instance for instance in found if instance in self.order), key=self.order.get)
+
+
 class Relation(object):
     """
     A relation is an arrow going from one or multiple claims to a claim
@@ -238,3 +377,89 @@ class Relation(object):
     def __repr__(self):
         return "Relation(sources={sources!r} target={target!r} type={type!r}, assumption={assumption!r})".format(**self.__dict__)
 
+
+if __name__ == '__main__':
+    import io
+    import contextlib
+    import argumentation
+    from datastructures import Numbering
+    from benchmark import evaluation_grammar, corpus
+
+    def test_blocking():
+        """
+        Test that comparing only the instances found by CoreferenceIndex and
+        the claims found by claim_signatures merges arguments the same way as
+        comparing all of them. Every sum made while parsing the corpus is
+        made a second time without them, with the same ids, and both have to
+        come out the same.
+        """
+        # The grammar uses the imported module, not this __main__ copy of it
+        add = argumentation.Argument.__add__
+        lookup = argumentation.CoreferenceIndex.lookup
+        signatures = argumentation.claim_signatures
+
+        class AllClaims(dict):
+            def __init__(self, claims):
+                super().__init__()
+                self.claims = list(claims)
+
+            def get(self, key, default=None):
+                return self.claims
+
+        def lookup_all(index, other):
+            return sorted(index.order.keys(), key=index.order.get)
+
+        def canonical(value):
+            # Sets of new relations iterate in a different order every time
+            if isinstance(value, argumentation.Argument):
+                return canonical(value.claims), canonical(value.relations), canonical(value.instances)
+            if isinstance(value, argumentation.Relation):
+                return canonical(value.sources), canonical(value.target), value.type, value.assumption
+            if isinstance(value, dict):
+                return [(canonical(key), canonical(item)) for key, item in value.items()]
+            if isinstance(value, (set, frozenset)):
+                return sorted(map(canonical, value), key=repr)
+            return repr(value)
+
+        ids = Numbering()
+        sums = 0
+        # The parser wraps what goes wrong in a callback, so the differences
+        # are collected instead of asserted where they are found.
+        differences = []
+
+        def checked_add(self, other):
+            nonlocal sums
+            values = dict(ids.values)
+            blocked = add(self, other)
+            blocked_values, ids.values = ids.values, values
+            argumentation.CoreferenceIndex.lookup = lookup_all
+            argumentation.claim_signatures = AllClaims
+            try:
+                unblocked = add(self, other)
+            finally:
+                argumentation.CoreferenceIndex.lookup = lookup
+                argumentation.claim_signatures = signatures
+            if canonical(blocked) != canonical(unblocked) or ids.values != blocked_values:
+                differences.append((blocked, unblocked))
+            sums += 1
+            return blocked
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            grammar = evaluation_grammar(anaphora=True)
+
+        argumentation.Argument.__add__ = checked_add
+        try:
+            for sentence in corpus('sentences.txt'):
+                try:
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        list(parser.Parser(grammar, 'ARGUMENT', numbering=ids).parse(parser.tokenize(sentence)))
+                except Exception:
+                    pass
+        finally:
+            argumentation.Argument.__add__ = add
+
+        assert sums > 0
+        assert not differences, "{!r} != {!r}".format(*differences[0])
+        print("Blocking merged {} sums the same as comparing everything".format(sums))
+
+    test_blocking()
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+"""
+Rough benchmarks for the Earley parser and the grammars built on top of it.
+
+Usage: python benchmark.py [benchmark ...]
+
+Without arguments all benchmarks are run. Timings are wall-clock and only
+meant to compare two versions of the code on the same machine.
+"""
+import contextlib
+import copy
+import gc
+import os
+import signal
+import sys
+import time
+import tracemalloc
+from typing import List
+
+import english
+import parser
+from grammar.shared import conditional, negation
+from grammar import recursive
+import hasl2.grammar
+
+
+TIMEOUT = 20  # seconds per sentence
+
+# The sentences from the __main__ section of hasl2/grammar.py
+HASL2_SENTENCES = [
+    'Tweety can fly because Tweety is a bird and animals can fly when they have wings unless they are a penguin .',
+    'The act is unlawful when someone\'s right is violated except when there is a justification .',
+    'The act is unlawful because someone\'s right was violated except there is a justification .',
+    'A suspect is innocent unless they are found guilty .',
+    'Claim A because claim B, claim C, and claim D.',
+    'the man who bested the king and took the throne or married the princess must reign the country.',
+    'A because B because C because D except E.',
+    'The ball is red when the material of the ball is red or when the light shining on it is red.',
+    'The ball is red if the ball looks red unless the light shining on it is red or if an expert says the ball is red except when the expert is not trustworthy or when the expert was misunderstood.',
+    'This ball is red because it looks red and balls are red when they look red except when the light is red.',
+    'This ball is red because it looks red and balls are red when they look red except the light is red.',
+    'A because B and C if D and E or if E and F.',
+    # and a longer chain of the kind that makes backtracking blow up
+    'A because B because C because D because E except F.',
+]
+
+DEVNULL = open(os.devnull, 'w')
+
+
+class Timeout(Exception):
+    pass
+
+
+def raise_timeout(signum, frame):
+    raise Timeout()
+
+
+def evaluation_grammar(**options):
+    return parser.CompiledGrammar(conditional.grammar(**options)
+        | negation.grammar(**options)
+        | recursive.grammar(**options))
+
+
+def corpus(path: str) -> List[str]:
+    sentences = []
+    for section in parser.read_sentences(path).values():
+        sentences.extend(section.values() if isinstance(section, dict) else section)
+    return sentences
+
+
+def run(grammar, start: str, sentence: str, **options):
+    """
+    Parse a sentence and return (seconds, number of chart states, outcome).
+    Options are passed on to the parser.
+    Whatever the grammar prints is swallowed here, so it does not end up in
+    the measurements.
+    """
+    signal.signal(signal.SIGALRM, raise_timeout)
+    signal.alarm(TIMEOUT)
+    p = parser.Parser(grammar, start, **options)
+    started = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(DEVNULL):
+            outcome = len(p.parse(parser.tokenize(sentence)))
+    except Timeout:
+        outcome = 'timeout'
+    except Exception as e:
+        outcome = e.__class__.__name__
+    finally:
+        signal.alarm(0)
+    elapsed = time.perf_counter() - started
+    return elapsed, sum(len(row) for row in p.table), outcome
+
+
+class ScanningIndex(dict):
+    """
+    Finds the rules for a nonterminal the way prediction did before rules
+    were indexed by name: by going through all of them.
+    """
+    def __init__(self, rules: List[parser.Rule]) -> None:
+        super().__init__()
+        self.rules = rules
+
+    def get(self, id, default=None):
+        return [rule for rule in self.rules if rule.id == id]
+
+
+def bench_sentences():
+    """Parse time per sentence of sentences.txt, scanning all rules vs. the index when predicting"""
+    grammar = evaluation_grammar(anaphora=True)
+    scanning = copy.copy(grammar)
+    scanning.index = ScanningIndex(grammar.rules)
+    totals = [0.0, 0.0]
+    for sentence in corpus('sentences.txt'):
+        (scan, _, scan_outcome), (indexed, states, outcome) = run(scanning, 'ARGUMENT', sentence), run(grammar, 'ARGUMENT', sentence)
+        assert scan_outcome == outcome or 'timeout' in (scan_outcome, outcome)
+        totals[0] += scan
+        totals[1] += indexed
+        print("scan {:8.3f}s  index {:8.3f}s  {:5.2f}x {:7d} states  {!s:>10}  {}".format(
+            scan, indexed, scan / indexed, states, outcome, sentence[:40]))
+    print("Total: scan {:.3f}s  index {:.3f}s  {:.2f}x".format(totals[0], totals[1], totals[0] / totals[1]))
+
+
+def bench_lazy():
+    """Parse time per sentence of sentences.txt, eager vs. lazy callbacks"""
+    grammar = evaluation_grammar(anaphora=True)
+    totals = [0.0, 0.0]
+    for sentence in corpus('sentences.txt'):
+        line = []
+        for n, lazy in enumerate((False, True)):
+            elapsed, states, outcome = run(grammar, 'ARGUMENT', sentence, lazy=lazy)
+            totals[n] += elapsed
+            line.append("{:8.3f}s {!s:>10}".format(elapsed, outcome))
+        print("eager {}  lazy {}  {}".format(*line, sentence[:50]))
+    print("Total: eager {:.3f}s  lazy {:.3f}s".format(*totals))
+
+
+def bench_lookahead():
+    """Chart size and parse time for sentences.txt, with and without lookahead"""
+    grammar = evaluation_grammar(anaphora=True)
+    totals = [0.0, 0, 0.0, 0]
+    for sentence in corpus('sentences.txt'):
+        line = []
+        for n, lookahead in enumerate((False, True)):
+            elapsed, states, outcome = run(grammar, 'ARGUMENT', sentence, lookahead=lookahead)
+            totals[2 * n] += elapsed
+            totals[2 * n + 1] += states
+            line.append("{:8.3f}s {:7d} states {!s:>10}".format(elapsed, states, outcome))
+        print("plain {}  lookahead {}  {}".format(*line, sentence[:40]))
+    print("Total: plain {:.3f}s {} states  lookahead {:.3f}s {} states".format(*totals))
+
+
+def bench_test_cache():
+    """Terminal test cache hit rates over sentences.txt, per parse and shared"""
+    grammar = evaluation_grammar(anaphora=True)
+    shared = parser.TestCache(maxsize=10000)
+    for label, cache_tests in (('none', False), ('per parse', True), ('shared', shared)):
+        hits, misses, total = 0, 0, 0.0
+        for sentence in corpus('sentences.txt'):
+            p = parser.Parser(grammar, 'ARGUMENT', lazy=True, cache_tests=cache_tests)
+            started = time.perf_counter()
+            try:
+                with contextlib.redirect_stdout(DEVNULL):
+                    p.parse(parser.tokenize(sentence))
+            except Exception:
+                pass
+            total += time.perf_counter() - started
+            if p.test_stats is not None and cache_tests is True:
+                hits, misses = hits + p.test_stats['hits'], misses + p.test_stats['misses']
+        if cache_tests is shared:
+            hits, misses = shared.hits, shared.misses
+        print("{:>9}: {:8.3f}s  {:6d} hits {:6d} misses  hit rate {:.0%}".format(
+            label, total, hits, misses, hits / (hits + misses) if hits + misses > 0 else 0))
+
+
+def bench_validation():
+    """Parse time per sentence of evaluation.tex, validating every callback vs. only the parses"""
+    grammar = evaluation_grammar(anaphora=True)
+    totals = [0.0, 0.0]
+    for sentence in corpus('evaluation.tex'):
+        line = []
+        for n, defer_validation in enumerate((False, True)):
+            elapsed, states, outcome = run(grammar, 'ARGUMENT', sentence, defer_validation=defer_validation)
+            totals[n] += elapsed
+            line.append("{:8.3f}s {!s:>10}".format(elapsed, outcome))
+        print("every callback {}  deferred {}  {}".format(*line, sentence[:40]))
+    print("Total: every callback {:.3f}s  deferred {:.3f}s".format(*totals))
+
+
+def bench_trace():
+    """Memory allocated while parsing sentences.txt, with and without traces"""
+    grammar = evaluation_grammar(anaphora=True)
+    sentences = [sentence for sentence in corpus('sentences.txt') if run(grammar, 'ARGUMENT', sentence)[2] != 'timeout']
+    for trace in (True, False):
+        gc.collect()
+        tracemalloc.start()
+        started = time.perf_counter()
+        for sentence in sentences:
+            run(grammar, 'ARGUMENT', sentence, trace=trace)
+        elapsed = time.perf_counter() - started
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("trace={!s:5}  {:8.3f}s  peak {:8.1f} KiB".format(trace, elapsed, peak / 1024))
+
+
+def bench_memory():
+    """Peak memory while parsing the sentences of evaluation.tex"""
+    grammar = evaluation_grammar(anaphora=True)
+    largest, total = 0, 0
+    for sentence in corpus('evaluation.tex'):
+        gc.collect()
+        tracemalloc.start()
+        elapsed, states, outcome = run(grammar, 'ARGUMENT', sentence)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        largest, total = max(largest, peak), total + peak
+        print("{:8.1f} KiB {:7d} states  {!s:>10}  {}".format(peak / 1024, states, outcome, sentence[:60]))
+    print("Largest peak: {:.1f} KiB, sum of peaks: {:.1f} KiB".format(largest / 1024, total / 1024))
+
+
+def bench_longest():
+    """Peak memory and parse time for the five longest sentences of sentences.txt that parse"""
+    grammar = evaluation_grammar(anaphora=True)
+    sentences = [sentence for sentence in corpus('sentences.txt') if isinstance(run(grammar, 'ARGUMENT', sentence)[2], int)]
+    sentences = sorted(sentences, key=lambda sentence: len(parser.tokenize(sentence)))[-5:]
+    for lazy in (False, True):
+        for sentence in sentences:
+            gc.collect()
+            tracemalloc.start()
+            elapsed, states, outcome = run(grammar, 'ARGUMENT', sentence, lazy=lazy)
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print("{:5} {:8.1f} KiB {:8.3f}s {!s:>10}  {}".format('lazy' if lazy else 'eager', peak / 1024, elapsed, outcome, sentence[:50]))
+
+
+def bench_english():
+    """Time to inflect the vocabulary of sentences.txt and evaluation.tex, by the rules vs. cached"""
+    vocabulary = sorted(set(word for path in ('sentences.txt', 'evaluation.tex')
+        for sentence in corpus(path) for word in parser.tokenize(sentence)))
+    rounds = 20
+
+    def rules(word):
+        english._singularize(word, english.NOUN, {})
+        english._pluralize(word, english.NOUN, {}, True)
+
+    def cached(word):
+        english.is_plural(word)
+        english.pluralize(word)
+
+    english.clear_caches()
+    for label, inflect in (('rules', rules), ('cached', cached)):
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for word in vocabulary:
+                inflect(word)
+        elapsed = time.perf_counter() - started
+        print("{:>6}: {:8.3f}s  {:6.2f}us per word".format(label, elapsed, elapsed / (rounds * len(vocabulary)) * 1e6))
+    print("{} words, {} rounds".format(len(vocabulary), rounds))
+
+
+def run_hasl2(sentence: str, **options):
+    """
+    Parse a sentence with the hasl2 grammar and return (seconds, parses),
+    where parses is the list of parses or the name of what went wrong.
+    """
+    signal.signal(signal.SIGALRM, raise_timeout)
+    signal.alarm(TIMEOUT)
+    started = time.perf_counter()
+    try:
+        outcome = list(hasl2.grammar.parse(sentence, start='sentence', **options))
+    except Timeout:
+        outcome = 'timeout'
+    except Exception as e:
+        outcome = e.__class__.__name__
+    finally:
+        signal.alarm(0)
+    return time.perf_counter() - started, outcome
+
+
+def bench_hasl2_packrat():
+    """Parse time for the hasl2 sentences, backtracking vs. packrat"""
+    totals = [0.0, 0.0]
+    for sentence in HASL2_SENTENCES:
+        (plain, plain_parses), (memoized, memoized_parses) = run_hasl2(sentence), run_hasl2(sentence, memoize=True)
+        totals[0] += plain
+        totals[1] += memoized
+        assert repr(plain_parses) == repr(memoized_parses) or plain_parses == 'timeout'
+        print("backtracking {:8.3f}s  packrat {:8.3f}s  {!s:>3} parses  {}".format(plain, memoized,
+            len(memoized_parses) if isinstance(memoized_parses, list) else memoized_parses, sentence[:50]))
+    print("Total: backtracking {:.3f}s  packrat {:.3f}s".format(*totals))
+
+
+def bench_hasl2_chart():
+    """Parse time for the hasl2 sentences, backtracking vs. chart"""
+    totals = [0.0, 0.0]
+    for sentence in HASL2_SENTENCES:
+        (plain, plain_parses), (chart, chart_parses) = run_hasl2(sentence), run_hasl2(sentence, chart=True)
+        totals[0] += plain
+        totals[1] += chart
+        assert sorted(map(repr, plain_parses)) == sorted(map(repr, chart_parses)) or plain_parses == 'timeout'
+        print("backtracking {:8.3f}s  chart {:8.3f}s  {!s:>3} parses  {}".format(plain, chart,
+            len(chart_parses) if isinstance(chart_parses, list) else chart_parses, sentence[:50]))
+    print("Total: backtracking {:.3f}s  chart {:.3f}s".format(*totals))
+
+
+def bench_leo():
+    """Right-recursive conjunctions of 10 to 200 items, eager vs. lazy with and without Leo"""
+    grammar = parser.CompiledGrammar([
+        parser.Rule('LIST', [parser.RuleRef('ITEM')]),
+        parser.Rule('LIST', [parser.RuleRef('ITEM'), parser.Literal(','), parser.RuleRef('LIST')]),
+        parser.Rule('LIST', [parser.RuleRef('ITEM'), parser.Literal('and'), parser.RuleRef('ITEM')]),
+        parser.Rule('ITEM', [parser.Literal('a')]),
+    ])
+    for length in (10, 25, 50, 100, 200):
+        tokens = ['a', ','] * (length - 2) + ['a', 'and', 'a']
+        line = []
+        for options in (dict(), dict(lazy=True, leo=False), dict(lazy=True)):
+            gc.collect()
+            started = time.perf_counter()
+            p = parser.Parser(grammar, 'LIST', **options)
+            assert len(p.parse(tokens)) == 1
+            line.append("{:8.3f}s {:7d} states".format(time.perf_counter() - started, sum(len(row) for row in p.table)))
+            del p
+        print("{:3d} items: eager {}  lazy {}  leo {}".format(length, *line))
+
+
+def bench_ambiguity():
+    """Time to the first parse of a highly ambiguous sentence, eager vs. SPPF"""
+    rules = [
+        parser.Rule('A', [parser.RuleRef('A'), parser.RuleRef('A')]),
+        parser.Rule('A', [parser.Literal('a')]),
+    ]
+    for length in (4, 6, 8, 10, 12):
+        tokens = ['a'] * length
+        line = []
+        for sppf in (False, True):
+            gc.collect()
+            started = time.perf_counter()
+            p = parser.Parser(rules, 'A', sppf=sppf)
+            parses = iter(p.parse(tokens))
+            next(parses)
+            line.append("{:8.3f}s {:7d} states".format(time.perf_counter() - started, sum(len(row) for row in p.table)))
+            del p, parses
+        print("{:3d} tokens: eager {}  sppf {}".format(length, *line))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        benchmarks = [globals()[arg] for arg in sys.argv[1:]]
+    else:
+        benchmarks = [value for name, value in dict(globals()).items() if name.startswith('bench_') and callable(value)]
+
+    for benchmark in benchmarks:
+        print("{}: {}".format(benchmark.__name__, benchmark.__doc__))
+        benchmark()
+        print()
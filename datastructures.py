@@ -1,16 +1,143 @@
-from collections import OrderedDict, MutableSet
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableSet
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, Optional, TypeVar
+
 
 class Sequence(object):
-    """Simple sequence utility class, for creating id's"""
+    """
+    Simple sequence utility class, for creating id's. Inside a numbering()
+    block the id's come from that block's Numbering instead, so they start
+    at 1 again and do not depend on what other threads are doing.
+    """
     def __init__(self):
+        self.lock = threading.Lock()
         self.reset()
 
     def reset(self):
         self.value = 0
 
     def next(self):
-        self.value += 1
-        return self.value
+        numbering = getattr(_numbering, 'current', None)
+        if numbering is not None:
+            return numbering.next(self)
+        with self.lock:
+            self.value += 1
+            return self.value
+
+
+class Numbering(object):
+    """
+    The counters of all sequences for a single piece of work, e.g. a parse
+    and everything that is built from it. Only use it from one thread at
+    a time.
+    """
+    def __init__(self):
+        self.values = {}  # type: Dict[Sequence, int]
+
+    def __repr__(self):
+        return "Numbering({} sequences)".format(len(self.values))
+
+    def next(self, sequence: Sequence) -> int:
+        self.values[sequence] = self.values.get(sequence, 0) + 1
+        return self.values[sequence]
+
+
+_numbering = threading.local()
+
+
+@contextmanager
+def numbering(ids: Optional[Numbering] = None):
+    """
+    Draws the id's of all sequences from ids (or a new Numbering) for this
+    thread, for the duration of the with block. Pass the same Numbering
+    again to continue where it left off. Objects numbered by different
+    Numberings can have the same id, so they should not be mixed.
+    """
+    previous = getattr(_numbering, 'current', None)
+    _numbering.current = ids if ids is not None else Numbering()
+    try:
+        yield _numbering.current
+    finally:
+        _numbering.current = previous
+
+
+T = TypeVar('T')
+
+
+def numbered(ids: Numbering, iterable: Iterable[T]) -> Iterator[T]:
+    """
+    Takes each item from iterable inside numbering(ids), for iterators that
+    create objects while they are consumed.
+    """
+    iterator = iter(iterable)
+    while True:
+        with numbering(ids):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+class BudgetExceeded(Exception):
+    """
+    Raised by a parser that ran out of its Budget. limit is the limit that
+    was hit ('states', 'steps' or 'seconds'), and stats the work that was
+    done until then, see Budget.stats.
+    """
+    def __init__(self, limit: str, stats: Dict[str, Any]):
+        super().__init__('Parse exceeded its budget of {} {} ({} states, {} steps, {:.3f} seconds)'.format(
+            stats['max_' + limit], limit, stats['states'], stats['steps'], stats['seconds']))
+        self.limit = limit
+        self.stats = stats
+
+
+class Budget(object):
+    """
+    The work a parse may do: at most max_states chart states, at most
+    max_steps steps, and no longer than seconds from when the Budget was
+    made. Leave any of them None for no limit. The parsers spend() it while
+    they work, and what they count as a state and a step differs per parser,
+    so the numbers are only comparable between parses by the same kind of
+    parser. Make a new one for every parse (or for every request, when the
+    work of several parses should add up), and only use it from one thread
+    at a time.
+    """
+    def __init__(self, max_states: Optional[int] = None, max_steps: Optional[int] = None, seconds: Optional[float] = None):
+        self.max_states = max_states
+        self.max_steps = max_steps
+        self.seconds = seconds
+        self.started = time.monotonic()
+        self.deadline = self.started + seconds if seconds is not None else None
+        self.states = 0
+        self.steps = 0
+
+    def __repr__(self):
+        return "Budget({states} of {max_states} states, {steps} of {max_steps} steps, {seconds:.3f} of {max_seconds} seconds)".format(**self.stats)
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return dict(
+            states=self.states, max_states=self.max_states,
+            steps=self.steps, max_steps=self.max_steps,
+            seconds=time.monotonic() - self.started, max_seconds=self.seconds)
+
+    def spend(self, steps: int = 1, states: int = 0) -> None:
+        """
+        Counts the steps and states, and raises BudgetExceeded if that was
+        more than the budget allows, or if the time is up.
+        """
+        self.steps += steps
+        self.states += states
+        if self.max_steps is not None and self.steps > self.max_steps:
+            raise BudgetExceeded('steps', self.stats)
+        if self.max_states is not None and self.states > self.max_states:
+            raise BudgetExceeded('states', self.stats)
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise BudgetExceeded('seconds', self.stats)
 
 
 class OrderedSet(MutableSet):
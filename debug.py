@@ -1,3 +1,9 @@
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, List, Tuple
+
+
 class Logger(object):
     def info(self, message: str):
         raise NotImplementedError()
@@ -21,9 +27,22 @@ class Console(Logger):
 
 
 class Boolean(object):
-    def __init__(self, value, reason = None):
+    """
+    A truth value with the reason for it. The reason can be a format string
+    followed by its arguments, in which case it is only formatted when
+    someone asks for it.
+    """
+    def __init__(self, value, reason = None, *args):
         self.value = bool(value)
-        self.reason = reason
+        self._reason = reason
+        self._args = args
+
+    @property
+    def reason(self):
+        if self._args:
+            self._reason = self._reason.format(*self._args)
+            self._args = ()
+        return self._reason
 
     def __bool__(self):
         return self.value
@@ -35,10 +54,65 @@ class Boolean(object):
         return "<{!r}: {!s}>".format(self.value, self.reason)
 
 
-def print_comparator(func):
+class Sink(object):
+    """
+    Receives the comparisons made by functions decorated with comparator()
+    while it is installed with tracing().
+    """
+    def record(self, comparator: str, args: Tuple[Any, ...], result: Any):
+        raise NotImplementedError()
+
+
+class Printer(Sink):
+    """Prints every comparison, like the comparators used to do."""
+    def record(self, comparator: str, args: Tuple[Any, ...], result: Any):
+        print("{}\n\t{!r}\n\t{!r}:\n\t> {}\n".format(comparator, args[0], args[1], result))
+
+
+class Recorder(Sink):
+    """
+    Keeps the comparisons, and only formats them when lines() is called.
+    Comparisons made inside another one come before it.
+    """
+    def __init__(self):
+        self.comparisons = []  # type: List[Tuple[str, Tuple[Any, ...], Any]]
+
+    def record(self, comparator: str, args: Tuple[Any, ...], result: Any):
+        self.comparisons.append((comparator, args, result))
+
+    def lines(self) -> List[str]:
+        return ["{}({!s}, {!s}): {!s}".format(comparator, args[0], args[1], result)
+            for comparator, args, result in self.comparisons]
+
+
+_tracing = threading.local()
+
+
+@contextmanager
+def tracing(sink: Sink):
+    """
+    Sends the comparisons made by this thread to the sink for the duration
+    of the with block.
+    """
+    previous = getattr(_tracing, 'sink', None)
+    _tracing.sink = sink
+    try:
+        yield sink
+    finally:
+        _tracing.sink = previous
+
+
+def comparator(func):
+    """
+    Reports the calls to func and their results to the sink installed with
+    tracing(), if there is one. Without one it costs a lookup.
+    """
+    @wraps(func)
     def wrapper(*args, **kwargs):
-        print("{}\n\t{!r}\n\t{!r}:".format(func.__name__, args[0], args[1]))
+        sink = getattr(_tracing, 'sink', None)
+        if sink is None:
+            return func(*args, **kwargs)
         result = func(*args, **kwargs)
-        print("\t> {}\n".format(result))
+        sink.record(func.__name__, args, result)
         return result
-    return wrapper
\ No newline at end of file
+    return wrapper
@@ -18,6 +18,7 @@
 # 96% for Verbs.find_lexeme() (for regular verbs)
 
 import re
+from functools import lru_cache
 
 VERB, NOUN, ADJECTIVE, ADVERB = "VB", "NN", "JJ", "RB"
 
@@ -371,6 +372,15 @@ def pluralize(word, pos=NOUN, custom={}, classical=True):
     """
     if word in custom:
         return custom[word]
+    if custom:
+        plural = _pluralize(word, pos, custom, classical)
+    else:
+        plural = _pluralize_cached(str(word), pos, classical)
+    return word if plural is None else plural
+
+def _pluralize(word, pos, custom, classical):
+    """ Returns the plural of a given word, or None if it does not inflect.
+    """
     # Recurse genitives.
     # Remove the apostrophe and any trailing -s, 
     # form the plural of the resultant noun, and then append an apostrophe (dog's => dogs').
@@ -410,7 +420,11 @@ def pluralize(word, pos=NOUN, custom={}, classical=True):
                 if word in plural_categories[category] and (not classic or (classic and classical)):
                     if suffix.search(word) is not None:
                         return suffix.sub(inflection, word)
-    return word
+    return None
+
+@lru_cache(maxsize=4096)
+def _pluralize_cached(word, pos, classical):
+    return _pluralize(word, pos, {}, classical)
 
 #print pluralize("part-of-speech")
 #print pluralize("child")
@@ -569,11 +583,37 @@ singular_irregular = {
             "zoa": "zoon",
 }
 
+# For performance, precompute what singularize() tests every word against:
+# all suffixes of the uninflected and uncountable words (which are returned
+# as they are), and the plural endings of the -ie and irregular words.
+singular_unchanged = set(x[i:] for x in singular_uninflected | singular_uncountable for i in range(len(x) + 1))
+singular_ie_suffixes = tuple(x + "s" for x in singular_ie)
+singular_irregular_suffixes = tuple(singular_irregular)
+singular_irregular_rules = [(x, re.compile('(?i)' + x + '$'), singular_irregular[x]) for x in singular_irregular]
+
 def singularize(word, pos=NOUN, custom={}):
     """ Returns the singular of a given word.
     """
     if word in custom:
         return custom[word]
+    if custom:
+        singular = _singularize(word, pos, custom)
+    else:
+        singular = _singularize_cached(str(word), pos)
+    if singular is None:
+        return word
+    if singular is _lowercase:
+        return word.lower()
+    return singular
+
+# What _singularize() returns for words whose singular is the word in lowercase,
+# so that the cache works for spans, whose lower() keeps their position.
+_lowercase = object()
+
+def _singularize(word, pos, custom):
+    """ Returns the singular of a given word, None if it does not inflect, or
+        _lowercase if it only needs to be put in lowercase.
+    """
     # Recurse compound words (e.g. mothers-in-law). 
     if "-" in word:
         w = word.split("-")
@@ -583,18 +623,14 @@ def singularize(word, pos=NOUN, custom={}):
     if word.endswith("'"):
         return singularize(word[:-1]) + "'s"
     w = word.lower()
-    for x in singular_uninflected:
-        if x.endswith(w):
-            return word
-    for x in singular_uncountable:
-        if x.endswith(w):
-            return word
-    for x in singular_ie:
-        if w.endswith(x+"s"):
-            return w
-    for x in singular_irregular:
-        if w.endswith(x):
-            return re.sub('(?i)'+x+'$', singular_irregular[x], word)
+    if w in singular_unchanged:
+        return None
+    if w.endswith(singular_ie_suffixes):
+        return _lowercase
+    if w.endswith(singular_irregular_suffixes):
+        for x, suffix, inflection in singular_irregular_rules:
+            if w.endswith(x):
+                return suffix.sub(inflection, word)
     for suffix, inflection in singular_rules:
         m = suffix.search(word)
         g = m and m.groups() or [] 
@@ -603,7 +639,17 @@ def singularize(word, pos=NOUN, custom={}):
                 if g[k] is None:
                     inflection = inflection.replace('\\' + str(k + 1), '')
             return suffix.sub(inflection, word)
-    return word
+    return None
+
+@lru_cache(maxsize=4096)
+def _singularize_cached(word, pos):
+    return _singularize(word, pos, {})
+
+def clear_caches():
+    """ Forgets the singulars and plurals looked up so far.
+    """
+    _singularize_cached.cache_clear()
+    _pluralize_cached.cache_clear()
 
 
 #### Tests for plural and singular abusing singularize's rules
@@ -704,3 +750,42 @@ def join(elements):
         return strings[0]
     else:
         return ''
+
+
+if __name__ == '__main__':
+    from parser import Span
+
+    def test_cache():
+        """Test that singularize and pluralize give the same with their caches as without, for strings and spans"""
+        uncached = {None: None}  # any custom replacements skip the caches
+        words = ["dog", "dogs", "dog's", "dogs'", "child", "children", "mothers-in-law",
+            "Postmasters General", "wolves", "movies", "matrices", "octopus", "my"]
+        words += list(singular_uninflected | singular_uncountable) + list(singular_irregular)
+        words += [x + "s" for x in singular_ie] + list(plural_prepositions)
+        words += [word for category in plural_categories.values() for word in category]
+        words += [word.capitalize() for word in words] + [word.upper() for word in words]
+        words += [Span(word, 3, 4) for word in words]
+
+        def same(a, b):
+            return type(a) is type(b) and repr(a) == repr(b)
+
+        clear_caches()
+        for n in range(2):  # once filling the caches, once from them
+            for word in words:
+                for pos in (NOUN, ADJECTIVE):
+                    assert same(singularize(word, pos), singularize(word, pos, uncached)), word
+                    for classical in (True, False):
+                        assert same(pluralize(word, pos, classical=classical), pluralize(word, pos, uncached, classical)), word
+        assert _singularize_cached.cache_info().hits > 0
+        assert _pluralize_cached.cache_info().hits > 0
+
+        # Both of those share how the result is made from the word itself
+        cookies, sheep, bar = Span("Cookies", 3, 4), Span("sheep", 3, 4), Span("bar", 3, 4)
+        assert repr(singularize(cookies)) == repr(Span("cookies", 3, 4))
+        assert singularize(sheep) is sheep
+        assert pluralize(bar, ADJECTIVE) is bar
+        assert singularize("children") == "child" and pluralize("child") == "children"
+        assert singularize("mothers-in-law") == "mother-in-law" and singularize("dogs'") == "dog's"
+        assert pluralize("matrix") == "matrices" and pluralize("matrix", classical=False) == "matrixes"
+
+    test_cache()
@@ -3,7 +3,7 @@ from parser import Rule, RuleRef, passthru, Literal
 from argumentation import Argument
 from interpretation import Interpretation
 from datastructures import Sequence
-from debug import Boolean, print_comparator
+from debug import Boolean, comparator
 
 class Scope(object):
     """
@@ -52,7 +52,7 @@ class Claim(object):
     def __str__(self):
         return "{subject!s} {verb!s} {object!s}".format(**self.__dict__)
 
-    @print_comparator
+    @comparator
     def is_same(self, other: 'Claim', argument: Argument) -> bool:
         if not isinstance(other, Claim):
             return Boolean(False, 'other not a claim')
@@ -5,7 +5,7 @@ from interpretation import Interpretation, Literal, Expression
 from datastructures import Sequence
 import english
 from decorators import memoize
-from debug import Boolean, print_comparator
+from debug import Boolean, comparator
 
 counter = Sequence()
 
@@ -48,32 +48,68 @@ class Instance(object):
     def is_same(self, other: 'Instance', argument: Argument) -> bool:
         return argument.get_instance(self) == argument.get_instance(other)
 
-    @print_comparator
+    @comparator
     def could_be(self, other: 'Instance') -> bool:
         if isinstance(other, GroupInstance):
-            return Boolean(False, '{}/{}: different class'.format(self.id, other.id))
+            return Boolean(False, '{}/{}: different class', self.id, other.id)
         elif self.scope != other.scope:
-            return Boolean(False, '{}/{}: different scope'.format(self.id, other.id))
+            return Boolean(False, '{}/{}: different scope', self.id, other.id)
         elif self.pronoun and self.pronoun.lower() == 'something':
-            return Boolean(other.pronoun and other.pronoun.after(self.pronoun) is not False and other.pronoun.lower() == 'it', '{}/{}: my pronoun is something, other pronoun is it'.format(self.id, other.id))
+            return Boolean(other.pronoun and other.pronoun.after(self.pronoun) is not False and other.pronoun.lower() == 'it', '{}/{}: my pronoun is something, other pronoun is it', self.id, other.id)
         elif self.pronoun and self.pronoun.lower() == 'someone':
-            return Boolean(other.pronoun and other.pronoun.after(self.pronoun) is not False and other.pronoun.lower() in ('he', 'she'), '{}/{}: my pronoun is someone, other pronoun is he/she'.format(self.id, other.id))
+            return Boolean(other.pronoun and other.pronoun.after(self.pronoun) is not False and other.pronoun.lower() in ('he', 'she'), '{}/{}: my pronoun is someone, other pronoun is he/she', self.id, other.id)
         elif self.name is not None:
             if other.name is not None and other.name.after(self.name) is not False:
-                return Boolean(self.name == other.name, '{}/{}: same name'.format(self.id, other.id))
+                return Boolean(self.name == other.name, '{}/{}: same name', self.id, other.id)
             elif self.pronoun is None:
-                return Boolean(other.pronoun and other.pronoun.after(self.name) is not False and other.pronoun.lower() in ('he', 'she'), '{}/{}: I have a name but my pronoun is None and other pronoun is he/she'.format(self.id, other.id))
+                return Boolean(other.pronoun and other.pronoun.after(self.name) is not False and other.pronoun.lower() in ('he', 'she'), '{}/{}: I have a name but my pronoun is None and other pronoun is he/she', self.id, other.id)
             else:
-                return Boolean(other.pronoun and other.pronoun.after(self.pronoun) is not False and self.pronoun.lower() == other.pronoun.lower(), '{}/{}: I have a name, but same pronoun'.format(self.id, other.id))
+                return Boolean(other.pronoun and other.pronoun.after(self.pronoun) is not False and self.pronoun.lower() == other.pronoun.lower(), '{}/{}: I have a name, but same pronoun', self.id, other.id)
         elif self.noun is not None:
             if other.noun is not None:
-                return Boolean(self.noun.before(other.noun) and self.noun == other.noun, '{}/{}: same noun'.format(self.id, other.id))
+                return Boolean(self.noun.before(other.noun) and self.noun == other.noun, '{}/{}: same noun', self.id, other.id)
             else:
-                return Boolean(other.pronoun and other.pronoun.after(self.noun) is not False and other.pronoun.lower() in ('he', 'she', 'it'), '{}/{}: other noun is none but pronoun is he/she/it'.format(self.id, other.id))
+                return Boolean(other.pronoun and other.pronoun.after(self.noun) is not False and other.pronoun.lower() in ('he', 'she', 'it'), '{}/{}: other noun is none but pronoun is he/she/it', self.id, other.id)
         elif self.pronoun and self.pronoun.lower() in ('he', 'she', 'it') and not other.name and not other.noun:
-            return Boolean(other.pronoun and other.pronoun.after(self.pronoun) is not False and self.pronoun.lower() == other.pronoun.lower(), '{}/{}: same pronoun'.format(self.id, other.id))
+            return Boolean(other.pronoun and other.pronoun.after(self.pronoun) is not False and self.pronoun.lower() == other.pronoun.lower(), '{}/{}: same pronoun', self.id, other.id)
         else:
-            return Boolean(False, '{}/{}: undefined case'.format(self.id, other.id))
+            return Boolean(False, '{}/{}: undefined case', self.id, other.id)
+
+    def coreference_keys(self):
+        """
+        The keys under which could_be() of another instance may say yes to
+        this one. Used by Argument to only compare plausible pairs.
+        """
+        keys = []
+        if self.name is not None:
+            keys.append((self.scope, 'name', str(self.name)))
+        if self.noun is not None:
+            keys.append((self.scope, 'noun'))
+        if self.pronoun:
+            keys.append((self.scope, 'pronoun', str(self.pronoun).lower()))
+        return keys
+
+    def coreference_candidates(self):
+        """
+        The keys of the instances this one could_be(), following its cases.
+        """
+        if self.pronoun and self.pronoun.lower() == 'something':
+            pronouns = ('it',)
+        elif self.pronoun and self.pronoun.lower() == 'someone':
+            pronouns = ('he', 'she')
+        elif self.name is not None:
+            return [(self.scope, 'name', str(self.name))] + [(self.scope, 'pronoun', pronoun)
+                for pronoun in (('he', 'she') if self.pronoun is None else (str(self.pronoun).lower(),))]
+        elif self.noun is not None:
+            # Compared with every other noun, not just the same one: could_be()
+            # raises on two nouns, and skipping those pairs would hide that.
+            return [(self.scope, 'noun')] + [(self.scope, 'pronoun', pronoun)
+                for pronoun in ('he', 'she', 'it')]
+        elif self.pronoun and self.pronoun.lower() in ('he', 'she', 'it'):
+            pronouns = (str(self.pronoun).lower(),)
+        else:
+            pronouns = ()
+        return [(self.scope, 'pronoun', pronoun) for pronoun in pronouns]
 
     def replaces(self, instance: 'Instance') -> bool:
         """
@@ -170,6 +206,12 @@ class GroupInstance(object):
         else:
             return Boolean(False, 'undefined case')
 
+    def coreference_keys(self):
+        return [(self.scope, 'group')]
+
+    def coreference_candidates(self):
+        return [(self.scope, 'group')]
+
     def replaces(self, instance: 'GroupInstance') -> bool:
         """
         Test whether this instance is an updated version of the supplied instance.
@@ -224,6 +266,9 @@ class DumbInstance(Instance):
     def could_be(self, other: 'Instance') -> bool:
         return Boolean(False, 'anaphora resolution disabled')
 
+    def coreference_candidates(self):
+        return []
+
     def text(self, argument: Argument):
         return str(self)
 
@@ -251,6 +296,9 @@ class DumbGroupInstance(GroupInstance):
     def could_be(self, other: 'GroupInstance') -> bool:
         return Boolean(False, 'anaphora resolution disabled')
 
+    def coreference_candidates(self):
+        return []
+
     def text(self, argument: Argument):
         return str(self)
 
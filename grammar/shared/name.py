@@ -9,6 +9,9 @@ class NameParser(Symbol):
     def test(self, literal: str, position: int, state: State) -> bool:
         return literal[0].isupper() and literal not in ('He', 'She', 'It', 'They', 'Someone', 'Something')
 
+    def test_key(self, literal: str, position: int):
+        return literal
+
 
 @memoize
 def grammar(**kwargs):
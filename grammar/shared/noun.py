@@ -28,6 +28,10 @@ class NounParser(Symbol):
         else:
             return english.is_singular(literal)
 
+    def test_key(self, literal: str, position: int):
+        # Only whether it is the first word matters
+        return literal, position == 0
+
     def finish(self, literal: str, position: int, state: 'State'):
         span = super().finish(literal, position, state)
         return Interpretation(local=Noun(span, self.is_plural))
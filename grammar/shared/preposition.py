@@ -89,6 +89,9 @@ class PrepositionSymbol(Symbol):
     def test(self, literal: str, position: int, state: 'State') -> bool:
         return literal in prepositions
 
+    def test_key(self, literal: str, position: int):
+        return literal
+
 
 @memoize
 def grammar(**kwargs): 
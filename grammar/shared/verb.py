@@ -49,6 +49,9 @@ class VerbParser(Symbol):
         is_match = self.expression.match(literal) is not None
         return is_match is not self.negate
 
+    def test_key(self, literal: str, position: int):
+        return literal
+
     def __repr__(self) -> str:
         return "/{}/".format(self.expression.pattern)
 
@@ -14,7 +14,9 @@ import spacy
 
 import english
 import parser
+from datastructures import Sequence
 from parser import Rule, RuleRef, passthru, Continue
+from debug import comparator
 
 
 def coalesce(*args):
@@ -61,12 +63,11 @@ def singular_verb(verb):
 
 class Stamper(object):
     def __init__(self):
-        self.seq = 0
+        self.seq = Sequence()
         self.attr = '_id_stamp'
 
     def next(self):
-        self.seq += 1
-        return self.seq
+        return self.seq.next()
 
     def read(self, obj):
         if not hasattr(obj, self.attr):
@@ -165,8 +166,19 @@ class Mapping(object):
     def __init__(self, entries = []):
         self.entries = dict(entries)
         for key in self.entries.keys():
-            while id.read(self.entries[key]) != id.read(self.entries[id(self.entries[key])]):
-                self.entries[key] = self.entries[id.read(self.entries[key])]
+            self.entries[key] = self.resolve(key)
+
+    def resolve(self, key):
+        """Follow the chain of replacements from key, and point every step
+        of the chain directly to its end."""
+        steps = []
+        replacement = self.entries[key]
+        while self.entries[id(replacement)] is not replacement:
+            steps.append(id(replacement))
+            replacement = self.entries[id(replacement)]
+        for step in steps:
+            self.entries[step] = replacement
+        return replacement
 
     def __add__(self, other):
         return Mapping(chain(self.entries.items(), other.entries.items()))
@@ -175,7 +187,7 @@ class Mapping(object):
         if isinstance(obj, list):
             return list(self[el] for el in obj)
         else:
-            return self.entries[id.read(obj)] if id(obj) in self.entries else obj
+            return self.entries.get(id(obj), obj)
 
     def __setitem__(self, obj, replacement):
         self.entries[id(obj)] = replacement
@@ -223,6 +235,9 @@ class Tag(parser.Symbol):
     def test(self, literal, position, state):
         return self.tag.fullmatch(literal.tag_) and str(literal) not in self.exclude
 
+    def test_key(self, literal, position):
+        return literal.tag_, str(literal)
+
     def finish(self, literal, position, state):
         return Span(position, position + 1, [literal])
 
@@ -238,6 +253,9 @@ class Literal(parser.Symbol):
     def test(self, literal, position, state):
         return self.literal.fullmatch(str(literal)) and str(literal) not in self.exclude
 
+    def test_key(self, literal, position):
+        return str(literal)
+
     def finish(self, literal, position, state):
         return Span(position, position + 1, [literal])
 
@@ -316,6 +334,7 @@ class Entity(object):
             noun = self.noun if self.noun is not None else other.noun,
             pronoun = self.pronoun if self.pronoun is not None else other.pronoun)
 
+    @comparator
     def refers_to(self, other):
         """Test whether this instance refers to a (better defined) other instance"""
         if self.name:
@@ -355,7 +374,7 @@ class Claim(object):
         return "{ass}{subj} {verb} ({file}:{line})".format(ass="assume " if self.assumed else "", neg = "not " if self.negated else "", **self.__dict__)
 
     def __hash__(self):
-        return hash(str(self))
+        return hash(str(self).lower())
 
     @property
     def tooltip(self):
@@ -465,25 +484,35 @@ class Argument(object):
 
     @staticmethod
     def consolidate(claims, relations):
-        def replace(old, new, list):
-            old_ids = frozenset(id(el) for el in old)
-            for el in list:
-                if id(el[1]) in old_ids:
-                    el[1] = new
-
-        entities = [[id(entity), entity] for entity in sorted((entity for entity in chain.from_iterable(claim.entities for claim in claims) if entity.pos is not None), key=lambda entity: entity.pos)]
-
-        c = len(entities)
-        for m, entity in enumerate(entities[:c]):
-            for n, other_entity in enumerate(entities[m+1:c], m+1):
-                result = other_entity[1].refers_to(entity[1])
-                # print("Does {!r} ({}) refer to {!r} ({}): {!r}".format(other_entity[1], id(other_entity[1]), entity[1], id(entity[1]), result))
-                if result:
-                    merged = entity[1].merge(other_entity[1])
-                    entities.append([id(merged), merged])
-                    replace((entity[1], other_entity[1]), merged, entities)
-
-        mapping = Mapping(entities)
+        # Entities that refer to each other end up in the same set, which is
+        # represented by its root. Every root knows the entity its set has
+        # been merged into so far.
+        parent = dict()
+        merged = dict()
+
+        def find(key):
+            while parent[key] != key:
+                parent[key] = parent[parent[key]]
+                key = parent[key]
+            return key
+
+        entities = sorted((entity for entity in chain.from_iterable(claim.entities for claim in claims) if entity.pos is not None), key=lambda entity: entity.pos)
+
+        keys = [id(entity) for entity in entities]
+        for key, entity in zip(keys, entities):
+            parent[key] = key
+            merged[key] = entity
+
+        for m, key in enumerate(keys):
+            for other_key in keys[m+1:]:
+                entity, other_entity = merged[find(key)], merged[find(other_key)]
+                if other_entity.refers_to(entity):
+                    root = find(key)
+                    parent[find(other_key)] = root
+                    merged[root] = entity.merge(other_entity)
+                    parent[id(merged[root])] = root
+
+        mapping = Mapping((key, merged[find(key)]) for key in list(parent))
 
         entries = [[id(claim), claim] for claim in claims]
 
@@ -493,11 +522,10 @@ class Argument(object):
             entry[1] = updated
             entries.append([id(updated), updated])
 
-        # Merge all claims that are (or have become) equal
-        for m, entry in enumerate(entries):
-            for n, other_entry in enumerate(entries[m:], m):
-                if entry[1] == other_entry[1]:
-                    entries[n][1] = entry[1]
+        # Merge all claims that are (or have become) equal into the first one
+        first = dict()
+        for entry in entries:
+            entry[1] = first.setdefault(entry[1], entry[1])
 
         mapping += Mapping(entries)
         
@@ -2,7 +2,7 @@ import re
 import traceback
 from typing import List
 from functools import reduce
-from itertools import chain
+from itertools import chain, islice
 from pprint import pprint
 from collections import OrderedDict
 import os
@@ -11,18 +11,33 @@ import flask
 import spacy
 
 import parser
+import debug
+from datastructures import numbering
 from hasl1.grammar import hasl0_grammar, hasl1_grammar, Claim, Relation, Argument, Entity, Span, id
 from flask import Flask, render_template, request, jsonify
 
 
 def unique(iterable, key = lambda x: x):
-    elements = []
     seen = set()
     for el in iterable:
         if key(el) not in seen:
-            elements.append(el)
             seen.add(key(el))
-    return elements
+            yield el
+
+
+def with_comparisons(parses):
+    """
+    Adds to each parse the comparisons that were made while building it.
+    """
+    parses = iter(parses)
+    while True:
+        with debug.tracing(debug.Recorder()) as recorder:
+            try:
+                parse = next(parses)
+            except StopIteration:
+                return
+        parse['comparisons'] = recorder.lines()
+        yield parse
 
 
 class TokenizeError(Exception):
@@ -101,10 +116,17 @@ for sentence_file in sentence_files:
     sentences.update(parser.read_sentences(sentence_file))
 
 grammars = {
-    'HASL/0': hasl0_grammar,
-    'HASL/1': hasl1_grammar
+    'HASL/0': parser.CompiledGrammar(hasl0_grammar),
+    'HASL/1': parser.CompiledGrammar(hasl1_grammar)
 }
 
+# Terminal test outcomes, shared by all requests (and both grammars)
+test_cache = parser.TestCache(maxsize=100000)
+
+# The most work a single request may make the parser do, so one sentence
+# that happens to be very ambiguous does not keep a worker busy for minutes.
+parse_budget = dict(max_states=200000, seconds=10.0)
+
 @app.route('/')
 def hello():
     return render_template('index.html', sections=sentences, grammars=grammars)
@@ -116,21 +138,41 @@ def api_parse_sentence():
     tokens = nlp(request.args.get('sentence'))
     reply = dict(tokens=tokens, grammar=grammar_name)
 
+    # Everything made for this request is numbered from 1, also the claims
+    # and relations that only get their id while they are sent back.
+    with numbering():
+        return parse_sentence(grammar_name, tokens, reply)
+
+
+def parse_sentence(grammar_name, tokens, reply):
     try:
         try:
             grammar = grammars[grammar_name]
         except:
             raise Exception('Grammar {} not available'.format(grammar_name));
 
-        p = parser.Parser(grammar, 'sentences')
+        # Only the parses we send back are built, so take one more than we
+        # need to see whether there are more. The parse logs are only sent
+        # when asked for, as they are big and rarely looked at. The same goes
+        # for the comparisons made while building the parses, which are only
+        # recorded when asked for.
+        p = parser.Parser(grammar, 'sentences', sppf=True, lookahead=True, trace='trace' in request.args, cache_tests=test_cache, budget=parser.Budget(**parse_budget))
         parses = p.parse(tokens)
-        reply['parses'] = unique(parses, key=lambda parse: parse['data'])
+        if 'comparisons' in request.args:
+            parses = with_comparisons(parses)
+        reply['parses'] = list(islice(unique(parses, key=lambda parse: parse['data']), 21))
 
         if len(reply['parses']) > 20:
-            reply['warning'] = 'There were {} parses, but cut off at {}'.format(len(reply['parses']), 20)
+            reply['warning'] = 'There were more than {0} parses, but cut off at {0}'.format(20)
             reply['parses'] = reply['parses'][:20]
 
         return jsonify(reply)
+    except parser.BudgetExceeded as error:
+        reply['error'] = str(error)
+        reply['budget'] = error.stats
+        response = jsonify(reply)
+        response.status_code = 422
+        return response
     except Exception as error:
         traceback.print_exc()
         reply['error'] = "{}: {!s}\n{}".format(error.__class__.__name__, error, traceback.format_exc())
@@ -139,5 +181,5 @@ def api_parse_sentence():
         return response
 
 def run():
-    app.run(extra_files=sentence_files)
+    app.run(extra_files=sentence_files, threaded=True)
 
@@ -287,7 +287,7 @@ jQuery(function($) {
         return graph;
     }
 
-    function networkifyParse(parse, i) {
+    function networkifyParse(parse, i, loadDetail) {
         const $canvas = $('<canvas>').prop('tabIndex', 1);
         
         const graph = graphifyParse(parse.data, $canvas);
@@ -366,10 +366,32 @@ jQuery(function($) {
         });
 
         view('parse log', 'trace', 'glyphicon-sort-by-attributes', function() {
-            this.append($('<ol>')
-                .append($.map(parse.trace, function(step) {
-                    return $('<li>').text(step);
-                })));
+            const container = this;
+
+            // The server leaves the parse log out unless asked for it, so
+            // fetch it the first time it is shown.
+            container.one('show.bs.collapse', function() {
+                $.when(parse.trace || loadDetail(i, 'trace')).then(function(trace) {
+                    container.append($('<ol>')
+                        .append($.map(trace, function(step) {
+                            return $('<li>').text(step);
+                        })));
+                });
+            });
+        });
+
+        view('comparisons', 'comparisons', 'glyphicon-transfer', function() {
+            const container = this;
+
+            // Like the parse log, only recorded by the server when asked for.
+            container.one('show.bs.collapse', function() {
+                $.when(parse.comparisons || loadDetail(i, 'comparisons')).then(function(comparisons) {
+                    container.append($('<ol>')
+                        .append($.map(comparisons, function(comparison) {
+                            return $('<li>').text(comparison);
+                        })));
+                });
+            });
         });
 
         view('list of entities', 'entities', 'glyphicon-tags', function() {
@@ -412,6 +434,13 @@ jQuery(function($) {
 
         body.append('<span class="loading">Loading…</span>');
 
+        function loadDetail(i, detail) {
+            return $.get($('#parse-sentence-form').attr('action'), {sentence: sentence, grammar: grammar, [detail]: 1}, 'json')
+                .then(function(response) {
+                    return response.parses[i][detail];
+                });
+        }
+
         $.get($('#parse-sentence-form').attr('action'), {sentence: sentence, grammar: grammar}, 'json')
             .always(function(response, status) {
                 // No consistency :(
@@ -431,7 +460,7 @@ jQuery(function($) {
                             .append($.map(response.parses, function(parse, i) {
                                 return panel = $('<div>')
                                     .addClass('list-group-item')
-                                    .append(networkifyParse(parse, i));
+                                    .append(networkifyParse(parse, i, loadDetail));
                             }))
                         );
                         break;
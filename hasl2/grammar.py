@@ -1,9 +1,11 @@
 import re
+import threading
 from functools import partial, reduce
 from itertools import takewhile
+from heapq import merge
 import operator
 from typing import NamedTuple, List, Optional, Any
-from hasl2.parser import ruleset, rule, tlist, template, l, slot, empty, terminal, NoMatchException, sparselist
+from hasl2.parser import ruleset, rule, tlist, template, l, slot, empty, terminal, NoMatchException, sparselist, Parser, ChartParser, ranked, has_index, reverse_memo
 
 class Text(object):
 	def __init__(self, words):
@@ -362,9 +364,12 @@ class prepend(object):
 # ])
 
 
+token_pattern = re.compile(r"[\w'/]+|[.,!?;]")
+
+
 def tokenize(markers, sentence):
 	unit = []
-	for token in re.findall(r"[\w'/]+|[.,!?;]", sentence):
+	for token in token_pattern.findall(sentence):
 		if token in markers:
 			if len(unit) > 0:
 				yield Text(unit)
@@ -390,18 +395,107 @@ def concatenate(tokens):
 
 
 
-def parse(sentence, start = 'sentences'):
-	from hasl2.parser import Parser
-	parser = Parser(rules)
-	tokens = tokenize(rules.markers(), sentence)
-	return parser.parse(start, tokens)
+class Realisations(object):
+	"""
+	The realisations of one or more trees as texts, shortest first over all
+	of them together. They are only worked out as far as they are asked for,
+	and they are remembered, together with the realisations of the parts of
+	the trees, so asking for the next page of texts does not realise the
+	earlier ones again. Can be used from several threads at once.
+	"""
+
+	def __init__(self, parser, trees, start = 'sentences'):
+		self.parser = parser
+		self.trees = list(trees)
+		self.start = start
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		self.memo = reverse_memo()
+		self.realisations = ranked(merge(
+			*(self.parser.realisations(self.start, tree, self.memo) for tree in self.trees),
+			key=lambda realisation: realisation[0]))
+
+	def page(self, offset = 0, limit = None, budget = None):
+		"""
+		Yields the texts from offset on, and at most limit of them. Working
+		out texts that were not asked for before spends the budget, see
+		Parser.reverse. When it runs out, BudgetExceeded is raised. Then, or
+		when anything else goes wrong, the work done so far is forgotten, as
+		the realisations that were interrupted can't be resumed.
+		"""
+		n = offset
+		while limit is None or n < offset + limit:
+			with self.lock:
+				self.memo.budget = budget
+				try:
+					if not has_index(self.realisations, n):
+						return
+					length, words = self.realisations[n]
+				except BaseException:
+					self.reset()
+					raise
+				finally:
+					self.memo.budget = None
+			yield concatenate(map(str, words))
+			n += 1
+
+
+class Hasl2Engine(object):
+	"""
+	Everything parsing and reversing needs that does not depend on the
+	sentence, worked out once: the markers the tokenizer splits on, and one
+	parser of each kind, which keep their indexes of the rules. Parsers keep
+	no state between calls, so a single engine can serve any number of
+	requests, also from several threads at once.
+	"""
+
+	def __init__(self, rules):
+		self.rules = rules
+		self.markers = rules.markers()
+		self.parser = Parser(rules)
+		self.packrat_parser = Parser(rules, memoize=True)
+		self.chart_parser = ChartParser(rules)
+
+	def tokenize(self, sentence):
+		return tokenize(self.markers, sentence)
+
+	def parse(self, sentence, start = 'sentences', memoize = False, chart = False, budget = None):
+		if chart:
+			parser = self.chart_parser
+		elif memoize:
+			parser = self.packrat_parser
+		else:
+			parser = self.parser
+		return parser.parse(start, self.tokenize(sentence), budget)
 
+	def realisations(self, trees, start = 'sentences'):
+		return Realisations(self.parser, trees, start)
 
-def reverse(tree, start = 'sentences'):
-	from hasl2.parser import Parser
-	parser = Parser(rules)
-	for realisation in parser.reverse(start, tree):
-		yield concatenate(map(str, realisation))
+	def reverse(self, tree, start = 'sentences', offset = 0, limit = None, budget = None):
+		return self.realisations([tree], start).page(offset, limit, budget)
+
+	def parse_many(self, sentences, start = 'sentences', **options):
+		"""Yields a list of all parses for each of the sentences."""
+		for sentence in sentences:
+			yield list(self.parse(sentence, start, **options))
+
+	def reverse_many(self, trees, start = 'sentences', limit = None):
+		"""Yields a list of (at most limit) realisations for each of the trees."""
+		for tree in trees:
+			yield list(self.reverse(tree, start, limit=limit))
+
+
+engine = Hasl2Engine(rules)
+
+
+def parse(sentence, start = 'sentences', memoize = False, chart = False, budget = None):
+	return engine.parse(sentence, start, memoize=memoize, chart=chart, budget=budget)
+
+
+def reverse(tree, start = 'sentences', offset = 0, limit = None, budget = None):
+	return engine.reverse(tree, start, offset, limit, budget)
 
 
 if __name__ == '__main__':
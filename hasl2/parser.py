@@ -2,9 +2,11 @@ from typing import NamedTuple, List, Set, FrozenSet, Union, Optional
 from collections.abc import Sequence
 from pprint import pprint, pformat
 from collections import defaultdict
-from itertools import chain
+from itertools import chain, islice
 from functools import reduce, wraps
+from heapq import heappush, heappop, merge
 from operator import add
+from datastructures import BudgetExceeded
 
 
 DEBUG = False
@@ -85,6 +87,89 @@ class sparselist(list):
 		return merged
 
 
+class ranked(object):
+	"""
+	A sequence that takes its items from an iterator, but only as far as
+	they are asked for. Every item is taken from the iterator only once.
+	"""
+
+	def __init__(self, iterator):
+		self.iterator = iter(iterator)
+		self.items = []
+
+	def __getitem__(self, index):
+		while len(self.items) <= index:
+			try:
+				self.items.append(next(self.iterator))
+			except StopIteration:
+				raise IndexError(index)
+		return self.items[index]
+
+	def __iter__(self):
+		n = 0
+		while has_index(self, n):
+			yield self[n]
+			n += 1
+
+
+class packrat_memo(dict):
+	"""
+	The results of rules parsed at places in the sentence. A rule that is
+	parsed again at the same place while it is still being parsed there
+	(left recursion, or a cycle of rules) finds nothing. What the rules in
+	between find with that is incomplete, so it is not remembered, and they
+	are parsed again when they are needed later. The result of the rule that
+	recursed itself is remembered, as its own recursion can't add to it.
+	"""
+
+	def __init__(self):
+		super().__init__()
+		self.depths = dict()  # depth on the stack of each key being parsed
+		self.stack = []  # [key, lowest depth of the keys it saw being parsed]
+
+	def lookup(self, key):
+		"""
+		The remembered results for the key, nothing if it is being parsed,
+		or None if it has to be parsed (between begin() and end()).
+		"""
+		if key in self.depths:
+			frame = self.stack[-1]
+			frame[1] = min(frame[1], self.depths[key])
+			return []
+		return self.get(key)
+
+	def begin(self, key):
+		self.depths[key] = len(self.stack)
+		self.stack.append([key, len(self.stack)])
+
+	def end(self, key, results):
+		key, lowest = self.stack.pop()
+		depth = self.depths.pop(key)
+		if lowest >= depth:
+			self[key] = results
+		elif len(self.stack) > 0:
+			self.stack[-1][1] = min(self.stack[-1][1], lowest)
+
+
+class reverse_memo(dict):
+	"""
+	The realisations of the parts of trees worked out so far, and the Budget
+	that working out more of them spends, if any.
+	"""
+
+	def __init__(self, budget = None):
+		super().__init__()
+		self.budget = budget
+
+
+def has_index(sequence, index):
+	try:
+		sequence[index]
+		return True
+	except IndexError:
+		return False
+
+
 class rule(object):
 	def __init__(self, name, tokens, template):
 		self.name = name
@@ -323,24 +408,51 @@ class ParseException(Exception):
 
 
 class Parser(object):
-	def __init__(self, rules):
+	"""
+	Top-down backtracking parser. With memoize=True it runs as a packrat
+	parser: the results of parsing a rule at a certain position in the
+	sentence are remembered, so each (rule, position) pair is only parsed
+	once, however many times backtracking gets back to it. Positions are
+	indices into the list of words, so no slices of it are made either.
+	Results are the same, in the same order, as without memoize.
+
+	Left recursion finds nothing with memoize, see packrat_memo, instead of
+	recursing forever.
+
+	parse() takes an optional datastructures.Budget, which it spends a step
+	of for every rule it tries (and with memoize a state for every rule and
+	position it parses), and raises BudgetExceeded once it is used up.
+	"""
+
+	def __init__(self, rules, memoize = False):
 		self.rules = rules
+		self.memoize = memoize
 
 	# @unique_generator
-	def parse(self, rule_name, words):
-		for resolution, remaining_words in self._parse(rule_name, list(words)):
-			if len(remaining_words) == 0:
-				yield resolution
+	def parse(self, rule_name, words, budget = None):
+		words = list(words)
+		if self.memoize:
+			for resolution, end in self._parse_at(rule_name, words, 0, packrat_memo(), budget):
+				if end == len(words):
+					yield resolution
+		else:
+			for resolution, remaining_words in self._parse(rule_name, words, budget):
+				if len(remaining_words) == 0:
+					yield resolution
 	
-	def _parse(self, rule_name, words):
+	def _parse(self, rule_name, words, budget):
 		for rule in self.rules[rule_name]:
+			if budget is not None:
+				budget.spend()
 			try:
-				for acc, remaining_words in self._parse_rule(rule.tokens, words):
+				for acc, remaining_words in self._parse_rule(rule.tokens, words, budget):
 					yield rule.template.consume(acc), remaining_words
-			except:
+			except BudgetExceeded:
+				raise
+			except Exception:
 				raise ParseException("Error while parsing {!s}".format(rule))
 
-	def _parse_rule(self, tokens, words):
+	def _parse_rule(self, tokens, words, budget):
 		if len(tokens) == 0:
 			yield [], words
 
@@ -348,45 +460,250 @@ class Parser(object):
 			if len(words) == 0 or not tokens[0].test(words[0]):
 				return
 			else:
-				for resolution, remaining_words in self._parse_rule(tokens[1:], words[1:]):
+				for resolution, remaining_words in self._parse_rule(tokens[1:], words[1:], budget):
 					yield [tokens[0].consume(words[0])] + resolution, remaining_words
 		else:
-			for resolution, remaining_words in self._parse(tokens[0], words):
-				for continuation, cont_remaining_words in self._parse_rule(tokens[1:], remaining_words):
+			for resolution, remaining_words in self._parse(tokens[0], words, budget):
+				for continuation, cont_remaining_words in self._parse_rule(tokens[1:], remaining_words, budget):
 					yield [resolution] + continuation, cont_remaining_words
 
-	# @unique_generator
-	def reverse(self, rule_name, tree):
+	def _parse_at(self, rule_name, words, start, memo, budget):
+		key = (rule_name, start)
+		results = memo.lookup(key)
+		if results is None:
+			if budget is not None:
+				budget.spend(steps=0, states=1)
+			memo.begin(key)
+			results = []
+			for rule in self.rules[rule_name]:
+				if budget is not None:
+					budget.spend()
+				try:
+					for acc, end in self._parse_rule_at(rule.tokens, 0, words, start, memo, budget):
+						results.append((rule.template.consume(acc), end))
+				except BudgetExceeded:
+					raise
+				except Exception:
+					raise ParseException("Error while parsing {!s}".format(rule))
+			memo.end(key, results)
+		return results
+
+	def _parse_rule_at(self, tokens, n, words, start, memo, budget):
+		if n == len(tokens):
+			yield [], start
+
+		elif is_literal(tokens[n]):
+			if start == len(words) or not tokens[n].test(words[start]):
+				return
+			else:
+				for resolution, end in self._parse_rule_at(tokens, n + 1, words, start + 1, memo, budget):
+					yield [tokens[n].consume(words[start])] + resolution, end
+		else:
+			for resolution, end in self._parse_at(tokens[n], words, start, memo, budget):
+				for continuation, cont_end in self._parse_rule_at(tokens, n + 1, words, end, memo, budget):
+					yield [resolution] + continuation, cont_end
+
+	def reverse(self, rule_name, tree, offset = 0, limit = None, budget = None):
+		"""
+		Yields the realisations of the tree as a list of words, shortest
+		first, counting the characters of the words and a space after each.
+		Realisations of the same length come in a fixed order. Skips the first offset realisations, and stops after
+		limit of them if it is given. With a budget, every part of the tree
+		that is realised counts as a state, and every rule tried and every
+		realisation made as a step.
+		"""
+		realisations = self.realisations(rule_name, tree, reverse_memo(budget))
+		for length, words in islice(realisations, offset, None if limit is None else offset + limit):
+			yield words
+
+	def realisations(self, rule_name, tree, memo = None):
+		"""
+		All realisations of the tree as a ranked sequence of (length, words)
+		pairs. They are worked out only as far as they are asked for, and
+		the realisations of every part of the tree are shared by all the
+		realisations of the whole. Pass the same memo for several trees to
+		share them between those too. It keeps the trees in it alive. The
+		realisations spend the budget of the memo, see reverse_memo, when they
+		are worked out. When it runs out the sequence can't be taken further.
+		"""
+		return self._realisations(rule_name, tree, memo if memo is not None else reverse_memo())
+
+	def _realisations(self, rule_name, tree, memo):
+		# The tree is kept in the memo so its id is not reused while we need it
+		key = (rule_name, id(tree))
+		if key not in memo:
+			if memo.budget is not None:
+				memo.budget.spend(steps=0, states=1)
+			memo[key] = tree, ranked(self._reverse_rules(rule_name, tree, memo))
+		return memo[key][1]
+
+	def _reverse_rules(self, rule_name, tree, memo):
 		debug("reverse {!r} {!r}".format(rule_name, tree))
+		alternatives = []
 		for rule in self.rules[rule_name]:
+			if memo.budget is not None:
+				memo.budget.spend()
 			try:
 				flat = rule.template.reverse(tree)
 				debug('<{}>.reverse({!r}) returned true, continuing with {!r}'.format(rule_name, rule, flat))
-				yield from self._reverse(rule.tokens, flat)
+				alternatives.append(self._reverse(rule.tokens, flat, memo))
 			except NoMatchException as e:
 				debug('<{}>.reverse({!r}) failed because {}'.format(rule_name, rule, e))
-
-	def _reverse(self, tokens, flat):
+		return merge(*alternatives, key=lambda realisation: realisation[0])
+
+	def _reverse(self, tokens, flat, memo):
+		"""
+		Yields the (length, words) realisations of the tokens, shortest first,
+		by taking the realisations of the tokens themselves in order of their
+		combined length, starting with the first (shortest) of each.
+		"""
 		assert isinstance(flat, list)
 		debug("_reverse {!r} {!r}".format(tokens, flat))
-		if len(tokens) == 0:
-			if len(flat) == 0:
-				yield []
+		parts = []
+		for n, token in enumerate(tokens):
+			if is_literal(token):
+				try:
+					word = token.reverse(flat[n] if n < len(flat) else None)
+				except NoMatchException:
+					return
+				parts.append([(len(str(word)) + 1, [word])])
 			else:
-				raise Exception('Well I did not expect this case? Should I yield nothing now?')
+				parts.append(self._realisations(token, flat[n], memo))
+
+		if not all(has_index(part, 0) for part in parts):
+			return
+
+		if len(flat) > len(tokens):
+			raise Exception('Well I did not expect this case? Should I yield nothing now?')
+
+		first = (0,) * len(parts)
+		frontier = [(sum(part[0][0] for part in parts), first)]
+		seen = {first}
+		while len(frontier) > 0:
+			length, indices = heappop(frontier)
+			if memo.budget is not None:
+				memo.budget.spend()
+			yield length, [word for part, n in zip(parts, indices) for word in part[n][1]]
+			for m, n in enumerate(indices):
+				successor = indices[:m] + (n + 1,) + indices[m + 1:]
+				if successor not in seen and has_index(parts[m], n + 1):
+					seen.add(successor)
+					heappush(frontier, (length - parts[m][n][0] + parts[m][n + 1][0], successor))
+
+
+class ChartParser(Parser):
+	"""
+	Parses the same rulesets into the same structures as Parser, but first
+	recognises the sentence with an Earley chart, which takes polynomial time
+	and handles left recursion. Only then are the parses built, and only from
+	the rules that the chart says span the words they are tried on. The parses
+	are all the parses Parser would find, though not always in the same order.
+	Of a budget it spends a state for every item in the chart and a step for
+	every item it processes and every rule it builds a parse with.
+	"""
 
-		elif is_literal(tokens[0]):
-			try:
-				resolution = tokens[0].reverse(flat[0] if len(flat) > 0 else None)
-				for continuation in self._reverse(tokens[1:], flat[1:]):
-					yield [resolution] + continuation
-			except NoMatchException:
-				pass
-		
+	def __init__(self, rules, memoize = False):
+		super().__init__(rules, memoize)
+		self.nullable = self._nullable()
+
+	def parse(self, rule_name, words, budget = None):
+		words = list(words)
+		spans = self._recognise(rule_name, words, budget)
+		for resolution in self._derive(rule_name, 0, len(words), words, spans, packrat_memo(), budget):
+			yield resolution
+
+	def _nullable(self):
+		nullable = set()
+		changed = True
+		while changed:
+			changed = False
+			for rule in self.rules:
+				if rule.name not in nullable and all(isinstance(token, str) and token in nullable for token in rule.tokens):
+					nullable.add(rule.name)
+					changed = True
+		return nullable
+
+	def _recognise(self, rule_name, words, budget):
+		"""
+		Runs an Earley recogniser over the words, and returns for every
+		(rule name, start) pair the set of positions where it can end.
+		"""
+		nullable = self.nullable
+		spans = defaultdict(set)
+		chart = [list() for _ in range(len(words) + 1)]
+		seen = [set() for _ in range(len(words) + 1)]
+
+		def add(position, item):
+			if item not in seen[position]:
+				if budget is not None:
+					budget.spend(steps=0, states=1)
+				seen[position].add(item)
+				chart[position].append(item)
+
+		for rule in self.rules[rule_name]:
+			add(0, (rule, 0, 0))
+
+		for position in range(len(words) + 1):
+			n = 0
+			while n < len(chart[position]):
+				rule, dot, start = chart[position][n]
+				n += 1
+				if budget is not None:
+					budget.spend()
+				if dot == len(rule.tokens):
+					# Completion
+					spans[rule.name, start].add(position)
+					for waiting, waiting_dot, waiting_start in list(chart[start]):
+						if waiting_dot < len(waiting.tokens) and waiting.tokens[waiting_dot] == rule.name:
+							add(position, (waiting, waiting_dot + 1, waiting_start))
+				elif isinstance(rule.tokens[dot], str):
+					# Prediction, and skipping over nullables (Aycock & Horspool)
+					for predicted in self.rules[rule.tokens[dot]]:
+						add(position, (predicted, 0, position))
+					if rule.tokens[dot] in nullable:
+						add(position, (rule, dot + 1, start))
+				elif position < len(words) and rule.tokens[dot].test(words[position]):
+					# Scanning
+					add(position + 1, (rule, dot + 1, start))
+		return spans
+
+	def _derive(self, rule_name, start, end, words, spans, memo, budget):
+		key = (rule_name, start, end)
+		# A rule deriving itself over the same words finds nothing there, see
+		# packrat_memo, as it would never end otherwise
+		results = memo.lookup(key)
+		if results is None:
+			memo.begin(key)
+			results = []
+			for rule in self.rules[rule_name]:
+				if budget is not None:
+					budget.spend()
+				try:
+					for acc in self._derive_rule(rule.tokens, 0, start, end, words, spans, memo, budget):
+						results.append(rule.template.consume(acc))
+				except BudgetExceeded:
+					raise
+				except Exception:
+					raise ParseException("Error while parsing {!s}".format(rule))
+			memo.end(key, results)
+		return results
+
+	def _derive_rule(self, tokens, n, start, end, words, spans, memo, budget):
+		if n == len(tokens):
+			if start == end:
+				yield []
+
+		elif is_literal(tokens[n]):
+			if start < end and tokens[n].test(words[start]):
+				for continuation in self._derive_rule(tokens, n + 1, start + 1, end, words, spans, memo, budget):
+					yield [tokens[n].consume(words[start])] + continuation
 		else:
-			for resolution in self.reverse(tokens[0], flat[0]):
-				for continuation in self._reverse(tokens[1:], flat[1:]):
-					yield resolution + continuation
+			for middle in sorted(spans.get((tokens[n], start), ())):
+				if middle <= end:
+					for resolution in self._derive(tokens[n], start, middle, words, spans, memo, budget):
+						for continuation in self._derive_rule(tokens, n + 1, middle, end, words, spans, memo, budget):
+							yield [resolution] + continuation
+
 
 
 class claim(NamedTuple):
@@ -885,6 +1202,75 @@ def test_reverse_nesting():
 
 
 
+def test_left_recursion():
+	class claim(NamedTuple):
+		id: str
+
+	class conjunction(NamedTuple):
+		left: 'conjunction'
+		right: 'claim'
+
+	rules = ruleset([
+		rule('claims',
+			['claims', l('and'), 'claim'],
+			template(conjunction, left=slot(0), right=slot(2))),
+		rule('claims',
+			['claim'],
+			slot(0)),
+		rule('claim', [l('A')], template(claim, id='a')),
+		rule('claim', [l('B')], template(claim, id='b')),
+	])
+
+	parser = ChartParser(rules)
+
+	words = "A and B and A".split(' ')
+
+	trees = list(parser.parse('claims', words))
+	assert trees == [conjunction(conjunction(claim('a'), claim('b')), claim('a'))], trees
+
+	pprint(trees)
+
+
+def test_chart_cycle():
+	# a and b derive each other over the same word. c asks for b again once
+	# a is done, and should find the 'x' through a as well.
+	rules = ruleset([
+		rule('s', ['a'], slot(0)),
+		rule('s', ['c'], slot(0)),
+		rule('a', ['b'], slot(0)),
+		rule('a', [l('x')], slot(0)),
+		rule('b', ['a'], slot(0)),
+		rule('c', ['b'], slot(0)),
+	])
+
+	parser = ChartParser(rules)
+
+	trees = list(parser.parse('s', ['x']))
+	assert len(trees) == 2, trees
+
+	pprint(trees)
+
+
+def test_packrat_recursion():
+	# B only finds something through A, which is still being parsed when
+	# A -> B 'x' asks for it. C asks for B again once A is done.
+	rules = ruleset([
+		rule('s', ['a'], slot(0)),
+		rule('s', ['c'], slot(0)),
+		rule('a', ['b', l('x')], slot(0)),
+		rule('a', [l('a')], slot(0)),
+		rule('b', ['a'], slot(0)),
+		rule('c', ['b', l('y')], slot(0)),
+	])
+
+	parser = Parser(rules, memoize=True)
+
+	trees = list(parser.parse('s', "a y".split(' ')))
+	assert len(trees) == 1, trees
+
+	pprint(trees)
+
+
 if __name__ == '__main__':
 	DEBUG=False
 	# test_list()
@@ -895,7 +1281,10 @@ if __name__ == '__main__':
 	# test_generate()
 	# test_boxes_and_arrows()
 	# test_sparselist()
+	test_left_recursion()
+	test_chart_cycle()
 	test_reverse_nesting()
+	test_packrat_recursion()
 
 
 # for n, parsed in enumerate(parse(rules['extended_claim'][0], words)):
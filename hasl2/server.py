@@ -1,22 +1,56 @@
 import os
+import time
+import threading
 import traceback
 from functools import wraps
 from collections import OrderedDict
-from flask import Flask, render_template_string, request, jsonify, send_from_directory
+from flask import Flask, Response, render_template_string, request, jsonify, send_from_directory, json
 
-from hasl2.grammar import parse, reverse
+from hasl2.grammar import engine
 from hasl2.diagram import Diagram
 from parser import read_sentences
+from datastructures import Budget, BudgetExceeded
 
-def text_to_diagrams(text):
-	for arguments in parse(text):
+# The most work a single request may make the parser do, parsing or
+# reversing, so one sentence or diagram that happens to be very ambiguous
+# does not keep a worker busy for minutes.
+parse_budget = dict(max_steps=5000000, seconds=10.0)
+
+def request_budget(seconds = None):
+	"""
+	A new Budget for a request: parse_budget, or less time if the client
+	asked for less.
+	"""
+	limits = dict(parse_budget)
+	if seconds is not None and (limits.get('seconds') is None or seconds < limits['seconds']):
+		limits['seconds'] = seconds
+	return Budget(**limits)
+
+def text_to_diagrams(text, budget = None):
+	for arguments in engine.parse(text, budget=budget):
 		yield Diagram.from_arguments(arguments).to_object()
 
 
-def diagram_to_texts(diagram):
-	for tree in Diagram.from_object(diagram).to_arguments():
-		for realisation in reverse(tree):
-			yield realisation
+# The realisations of the diagrams that were asked for last, so the next
+# page of texts for a diagram continues where the previous one stopped.
+realisations_cache = OrderedDict()
+realisations_cache_size = 100
+realisations_lock = threading.Lock()
+
+def diagram_realisations(diagram):
+	key = json.dumps(diagram, sort_keys=True)
+	with realisations_lock:
+		if key in realisations_cache:
+			realisations_cache.move_to_end(key)
+		else:
+			realisations_cache[key] = engine.realisations(Diagram.from_object(diagram).to_arguments())
+			if len(realisations_cache) > realisations_cache_size:
+				realisations_cache.popitem(last=False)
+		return realisations_cache[key]
+
+
+def diagram_to_texts(diagram, offset = 0, limit = None, budget = None):
+	return diagram_realisations(diagram).page(offset, limit, budget)
 
 
 app = Flask(__name__, static_folder='../hasl1/static')
@@ -28,6 +62,10 @@ def handle_exceptions(fn):
 	def wrapper(*args, **kwargs):
 		try:
 			return fn(*args, **kwargs)
+		except BudgetExceeded as error:
+			response = jsonify(error=str(error), budget=error.stats)
+			response.status_code = 422
+			return response
 		except Exception as error:
 			traceback.print_exc()
 			response = jsonify(error=str(error))
@@ -35,6 +73,53 @@ def handle_exceptions(fn):
 			return response
 	return wrapper
 
+def stream(records, limit = None, budget = None):
+	"""
+	Sends the records as newline-delimited JSON, each one as soon as it is
+	made. Stops after limit records, or once the Budget that the records are
+	made with is used up. The last line says why it stopped: 'limit', 'time'
+	or 'budget' (with the budget's stats), null when there were no more
+	records, or the error that occurred.
+	"""
+	def lines():
+		count = 0
+		stopped = None
+		stats = None
+		try:
+			iterator = iter(records)
+			while True:
+				# Checked before the next record is made, not to waste work on it
+				if limit is not None and count >= limit:
+					stopped = 'limit'
+					break
+				if budget is not None and budget.deadline is not None and time.monotonic() > budget.deadline:
+					stopped = 'time'
+					stats = budget.stats
+					break
+				try:
+					record = next(iterator)
+				except StopIteration:
+					break
+				except BudgetExceeded as error:
+					stopped = 'time' if error.limit == 'seconds' else 'budget'
+					stats = error.stats
+					break
+				yield json.dumps(record) + '\n'
+				count += 1
+		except Exception as error:
+			traceback.print_exc()
+			yield json.dumps(dict(error=str(error), count=count)) + '\n'
+			return
+		yield json.dumps(dict(done=True, count=count, stopped=stopped, budget=stats)) + '\n'
+	return Response(lines(), mimetype='application/x-ndjson')
+
+def stream_options(default_limit = None):
+	limit = request.json.get('limit', default_limit)
+	seconds = request.json.get('budget')
+	return dict(
+		limit=int(limit) if limit is not None else None,
+		budget=request_budget(float(seconds) if seconds is not None else None))
+
 @app.route('/')
 def app_index():
 	with open('hasl2/hasl2.html', 'rb') as template:
@@ -51,24 +136,38 @@ def app_sentences():
 @app.route('/api/diagram', methods=['POST'])
 @handle_exceptions
 def app_text_to_diagram():
-	diagrams = list(text_to_diagrams(request.json['text']))
+	diagrams = list(text_to_diagrams(request.json['text'], request_budget()))
 	return jsonify(diagrams=diagrams)
 
 @app.route('/api/text', methods=['POST'])
 @handle_exceptions
 def app_diagram_to_text():
-	texts = list()
-	limit_reached = False
-	for text in diagram_to_texts(request.json['diagram']):
-		if len(texts) == 50: # Limit the amount of formulations, as these are a bit explosive
-			limit_reached = True
-			break
-		texts.append(text)
-	return jsonify(texts=texts, more=limit_reached)
+	# Limit the amount of formulations, as these are a bit explosive. The
+	# shortest come first, and the client can ask for the next ones by
+	# passing the offset to start at.
+	offset = int(request.json.get('offset', 0))
+	texts = list(diagram_to_texts(request.json['diagram'], offset, 51, request_budget()))
+	return jsonify(texts=texts[:50], more=len(texts) > 50, offset=offset)
+
+
+@app.route('/api/diagram/stream', methods=['POST'])
+@handle_exceptions
+def app_text_to_diagram_stream():
+	options = stream_options()
+	diagrams = text_to_diagrams(request.json['text'], options['budget'])
+	return stream((dict(diagram=diagram) for diagram in diagrams), **options)
+
+@app.route('/api/text/stream', methods=['POST'])
+@handle_exceptions
+def app_diagram_to_text_stream():
+	offset = int(request.json.get('offset', 0))
+	options = stream_options(default_limit=50)
+	texts = diagram_to_texts(request.json['diagram'], offset, budget=options['budget'])
+	return stream((dict(text=text) for text in texts), **options)
 
 
 def run():
-	app.run(port=5001)
+	app.run(port=5001, threaded=True)
 
 
 if __name__ == '__main__':
@@ -5,9 +5,8 @@ import re
 
 
 class Rule(parser.Rule):
-    def __init__(self, name, symbols, callback = None):
-        super().__init__(name, symbols, callback)
-        self.callback = lambda state, data: callback(state, data).validated()
+    def validate(self, value):
+        return value.validated()
 
 
 class Interpretation(object):
@@ -49,5 +48,8 @@ class Expression(Literal):
     def test(self, literal: str, position: int, state: 'State') -> bool:
         return self.expression.match(literal) is not None
 
+    def test_key(self, literal: str, position: int) -> Any:
+        return literal
+
     def __repr__(self) -> str:
         return "/{}/".format(self.expression.pattern)
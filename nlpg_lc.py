@@ -1,7 +1,8 @@
 from typing import List, Dict, Any, Iterator, NamedTuple, Optional
-from nlpg import Parser, rule, terminal, l, slot
+from hasl2.parser import Parser, rule, terminal, l, slot
 from pprint import pprint
 from collections import defaultdict
+from datastructures import Budget, BudgetExceeded
 
 # https://github.com/ssarkar2/LeftCornerParser/blob/master/LCParser.py
 
@@ -143,11 +144,17 @@ class Config(NamedTuple):
 
 
 class Parse(object):
-	def __init__(self, rules: List[rule], words: List[Any], goal: str):
+	"""
+	The parses of the words, found while iterating. With a budget, every
+	config that is put on the chart counts as a state and every one taken
+	off it as a step, and iterating raises BudgetExceeded once it is used up.
+	"""
+	def __init__(self, rules: List[rule], words: List[Any], goal: str, budget: Optional[Budget] = None):
 		self.rules = remove_embedded_tokens(rules)
 		self.words = list(words)
 		self.goal = goal
 		self.nullables = find_nullables(self.rules)
+		self.budget = budget
 
 	def __iter__(self):
 		chart = [Config([], 0)]
@@ -155,6 +162,8 @@ class Parse(object):
 		
 		while len(chart) > 0:
 			config = chart.pop()
+			if self.budget is not None:
+				self.budget.spend()
 
 			if config.index == len(self.words) \
 				and len(config.stack) == 1 \
@@ -165,6 +174,8 @@ class Parse(object):
 				configs = list(self.step(config))
 				chart.extend(configs)
 				self.counter += len(configs)
+				if self.budget is not None:
+					self.budget.spend(steps=0, states=len(configs))
 
 	def step(self, config: Config):
 		yield from self._advance(config)
@@ -249,15 +260,40 @@ class Parse(object):
 
 
 class LCParser(Parser):
-	def parse(self, rule_name, words):
-		return Parse(self.rules, words, rule_name)
+	def parse(self, rule_name, words, budget = None):
+		return Parse(self.rules, words, rule_name, budget)
+
+
+def test_budget():
+	from hasl2.parser import ruleset
+
+	# Every way to split the words into claims is a parse, so without a
+	# budget this would go on for a long time
+	rules = ruleset([
+		rule('claims', ['claim'], slot(0)),
+		rule('claims', ['claims', 'claims'], slot(0)),
+		rule('claim', [l('A')], slot(0)),
+	])
+
+	parse = LCParser(rules).parse('claims', ['A'] * 3)
+	assert len(list(parse)) == 2
+
+	budget = Budget(max_steps=100)
+	try:
+		list(LCParser(rules).parse('claims', ['A'] * 20, budget))
+		assert False, 'BudgetExceeded not raised'
+	except BudgetExceeded as e:
+		assert e.limit == 'steps' and e.stats['steps'] == 101, e.stats
+		print(e)
 
 
 if __name__ == '__main__':
-	import nlpg
-	from nlpg import ruleset, rule, tlist, template, l, slot, empty
+	import hasl2.parser as nlpg
+	from hasl2.parser import ruleset, rule, tlist, template, l, slot, empty
 	from pprint import pprint
 
+	test_budget()
+
 	class claim(NamedTuple):
 		id: str
 
@@ -269,13 +305,13 @@ if __name__ == '__main__':
 	rules = ruleset([
 		rule('extended_claims',
 			['extended_claim'],
-			tlist(head=0)),
+			tlist(head=slot(0))),
 		rule('extended_claims',
 			['extended_claim', l('and'), 'extended_claims'],
-			tlist(head=0, tail=2)),
+			tlist(head=slot(0), tail=slot(2))),
 		rule('extended_claim',
 			['claim', 'supports', 'attacks'],
-			template(argument, claim=0, supports=1, attacks=2)),
+			template(argument, claim=slot(0), supports=slot(1), attacks=slot(2))),
 		rule('claim',
 			[l('birds'), l('can'), l('fly')],
 			template(claim, id='b_can_f')),
@@ -299,10 +335,10 @@ if __name__ == '__main__':
 			tlist()),
 		rule('supports',
 			['support'],
-			tlist(0)),
+			tlist(head=slot(0))),
 		rule('supports',
 			['support', l('and'), 'supports'],
-			tlist(0, 2)),
+			tlist(head=slot(0), tail=slot(2))),
 		rule('support',
 			[l('because'), 'extended_claims'],
 			slot(1)),
@@ -311,10 +347,10 @@ if __name__ == '__main__':
 			tlist()),
 		rule('attacks',
 			['attack'],
-			tlist(0)),
+			tlist(head=slot(0))),
 		rule('attacks',
 			['attack', l('and'), 'attacks'],
-			tlist(0, 2)),
+			tlist(head=slot(0), tail=slot(2))),
 		rule('attack',
 			['attack_marker', 'extended_claims'],
 			slot(1)),
@@ -2,17 +2,21 @@
 
 # Based on https://github.com/Hardmath123/nearley/blob/master/lib/nearley.js
 import operator
-from typing import List, Optional, Any, Callable, Union, cast
+from typing import List, Dict, Set, Tuple, Iterator, Optional, Any, Callable, Union, ContextManager, cast
 from collections import OrderedDict
 import codecs
+import contextlib
 import functools
 import re
 import inspect
 import os
+import threading
 
 import traceback
 
-def log(line: str) -> None:
+from datastructures import Budget, BudgetExceeded, Numbering, numbering, numbered
+
+def log(line: str, *args) -> None:
     pass
 
 
@@ -63,6 +67,8 @@ class Span(str):
     in the text it originates from.
     """
 
+    __slots__ = ('start', 'end')
+
     def __new__(cls, value, *args, **kwargs):
         return super(Span, cls).__new__(cls, value)
 
@@ -126,10 +132,28 @@ def test_span():
 
 test_span()
 
+# Nonterminal names are interned to integers once, so that the parser can
+# compare them as ints. The ids are shared by all grammars, as the same rules
+# are often part of more than one of them.
+symbol_ids = {}  # type: Dict[str, int]
+
+
+def intern_symbol(name: str) -> int:
+    return symbol_ids.setdefault(name, len(symbol_ids))
+
+
 class Symbol:
     def test(self, literal: str, position: int, state: 'State') -> bool:
         raise NotImplementedError("Symbol.test is abstract")
 
+    def test_key(self, literal: str, position: int) -> Any:
+        """
+        Everything the outcome of test() depends on, for TestCache. Symbols
+        that do not care about the position should leave it out, so that
+        their outcomes can be shared between positions and sentences.
+        """
+        return literal, position
+
     def finish(self, literal: str, position: int, state: 'State'):
         return Span(literal, position, position + 1)
 
@@ -141,6 +165,9 @@ class Literal(Symbol):
     def test(self, literal: str, position: int, state: 'State') -> bool:
         return self.literal == literal
 
+    def test_key(self, literal: str, position: int) -> Any:
+        return literal
+
     def __repr__(self) -> str:
         return "\"{}\"".format(self.literal)
 
@@ -148,6 +175,7 @@ class Literal(Symbol):
 class RuleRef(Symbol):
     def __init__(self, name: str) -> None:
         self.name = name
+        self.id = intern_symbol(name)
 
     def test(self, literal: str, position: int, state: 'State') -> bool:
         return False
@@ -156,9 +184,33 @@ class RuleRef(Symbol):
         return "{}".format(self.name)
 
 
+def callback_signature(callback: Callable) -> Any:
+    """
+    Identifies what a callback does. Sub-grammars that are built more than
+    once make a new lambda for a rule every time, but with the same code and
+    closing over the same objects, and those count as the same callback.
+    """
+    code = getattr(callback, '__code__', None)
+    if code is None:
+        return callback
+    return (code, tuple(map(cell_signature, callback.__closure__ or ())))
+
+
+def cell_signature(cell) -> int:
+    """
+    Identifies what a closure cell holds, or the cell itself while nothing has
+    been assigned to it yet (e.g. a local function that calls itself).
+    """
+    try:
+        return id(cell.cell_contents)
+    except ValueError:
+        return id(cell)
+
+
 class Rule:
     def __init__(self, name: str, symbols: List[Symbol], callback: Optional[Callable[[Any, int], Any]] = None, file=None, line=None) -> None:
         self.name = name
+        self.id = intern_symbol(name)
         self.symbols = symbols
         if callback is not None:
             self.callback = callback
@@ -172,7 +224,30 @@ class Rule:
             (filename, line_number, function_name, lines, index) = inspect.getframeinfo(previous_frame)
             self.file = filename
             self.line = line_number
-        
+
+    @property
+    def callback(self) -> Callable[[Any, int], Any]:
+        return self._callback
+
+    @callback.setter
+    def callback(self, callback: Callable[[Any, int], Any]) -> None:
+        # Grammars often replace the callback after the rule is made, which
+        # changes what the rule does and thus its signature.
+        self._callback = callback
+        self._signature = None
+
+    @property
+    def signature(self):
+        """
+        Grammars are often combined from sub-grammars that share rules, so
+        the same rule can occur multiple times as different objects. The
+        chart treats rules as one and the same rule when they read the same
+        and do the same: same class (and thus validate()) and same callback.
+        """
+        if self._signature is None:
+            self._signature = (type(self), repr(self), callback_signature(self.callback))
+        return self._signature
+
     def __repr__(self, with_cursor_at: int = None) -> str:
         if with_cursor_at is not None:
             return "{} ⇒ {} ● {}".format(
@@ -192,10 +267,20 @@ class Rule:
     def consume(self, state: 'State'):
         return self
 
-    def finish(self, state: 'State', data: List[Any]) -> Any:
-        log("!!! Finishing {} with data {} and reference {}!".format(self.name, state.data, state.reference))
+    def validate(self, value: Any) -> Any:
+        """
+        Checks the value the callback returned, and returns it again (or
+        raises). Rules that need a check should override this instead of
+        folding it into their callback, so that the parser can postpone it
+        until a parse is complete (see Parser, defer_validation).
+        """
+        return value
+
+    def finish(self, state: 'State', data: List[Any], validate: bool = True) -> Any:
+        log("!!! Finishing {} with data {} and reference {}!", self.name, state.data, state.reference)
         try:
-            return self.callback(state, data)
+            value = self.callback(state, data)
+            return self.validate(value) if validate else value
         except Exception as e:
             if isinstance(e, Continue):
                 print("1111111")
@@ -218,6 +303,9 @@ class RuleInstance:
 
 
 class State:
+    # Charts hold many thousands of states, so they do without a __dict__.
+    __slots__ = ('rule', 'expect', 'reference', 'inp', 'data', 'previous', 'child', 'error')
+
     def __init__(self, rule: Rule, expect: int, reference: int) -> None:
         assert len(rule.symbols) > 0
         self.rule = rule
@@ -225,17 +313,55 @@ class State:
         self.reference = reference
         self.inp = []
         self.data = []  # type: List[Any]
-        self.trace = []
+        self.previous = None  # type: Optional[State] (the state this one was advanced from)
+        self.child = None  # type: Any (what the previous state consumed, see step())
         self.error = None
 
     def __repr__(self) -> str:
         return "{rule}, from: {ref} (data:{data!r})".format(rule=self.rule.__repr__(self.expect), ref=self.reference, data=self.data)
 
     def __eq__(self, other) -> bool:
-        return self.rule is other.rule \
-            and self.expect == other.expect \
-            and self.reference == other.reference \
-            and self.trace == other.trace
+        return self.key == other.key
+
+    @property
+    def key(self):
+        """
+        Identifies the state within a chart row: the position in the rule,
+        where the rule started, and the tokens and child states it was built
+        from. The trace is deliberately not part of it, as it only records
+        how those same children were consumed.
+        """
+        return (self.rule.signature, self.expect, self.reference, tuple(map(id, self.inp)))
+
+    @property
+    def trace(self) -> List[str]:
+        """
+        The steps that led to this state, in the order they were taken. They
+        are not recorded while parsing, but reconstructed from the
+        back-pointers when asked for.
+        """
+        trace = []  # type: List[str]
+        if self.previous is not None:
+            trace.extend(self.previous.trace)
+            trace.append(self.previous.step(self.child))
+            if isinstance(self.child, State):
+                trace.extend(self.child.trace)
+        if self.expect == len(self.rule.symbols):
+            trace.append('Finish rule {!r}'.format(self.rule))
+        return trace
+
+    def step(self, child) -> str:
+        """
+        Describes consuming the child, i.e. the symbol after the dot, which is
+        either a (token, position) tuple, a completed state or an empty Rule.
+        """
+        if isinstance(child, State):
+            return '{!r}: Consume non-terminal {!r}'.format(self.rule.__repr__(self.expect), child.rule)
+        elif isinstance(child, Rule):
+            return '{!r}: Consume non-terminal {!r}'.format(self.rule.__repr__(self.expect), child)
+        else:
+            inp, token_pos = child
+            return 'Consume terminal {!r}({}) with {!r}'.format(inp, token_pos, self.rule.symbols[self.expect])
 
     @property
     def tree(self):
@@ -247,49 +373,75 @@ class State:
         }
 
 
-    def nextState(self, inp, data, trace) -> 'State':
+    def nextState(self, inp, data, child) -> 'State':
         state = State(self.rule, self.expect + 1, self.reference)
         state.inp = self.inp + inp
         state.data = self.data + [data]
-        state.trace = trace + self.trace
+        state.previous = self
+        state.child = child
         return state
 
     def consumeTerminal(self, inp: str, token_pos: int) -> Optional['State']:
-        log("consumeTerminal {} using {} expecting {}".format(inp, self.rule, self.rule.symbols[self.expect] if len(
-            self.rule.symbols) > self.expect else '>END<'))
+        log("consumeTerminal {} using {} expecting {}", inp, self.rule, self.rule.symbols[self.expect] if len(
+            self.rule.symbols) > self.expect else '>END<')
         if len(self.rule.symbols) > self.expect and self.rule.symbols[self.expect].test(inp, token_pos, self):
             log("Terminal consumed")
-            try:
-                return self.nextState([inp], self.rule.symbols[self.expect].finish(inp, token_pos, self), ['Consume terminal {!r}({}) with {!r}'.format(inp, token_pos, self.rule.symbols[self.expect])])
-            except Exception as e:
-                raise Exception('Exception while trying to consume {!r} with {!r}'.format(inp, self.rule.symbols[self.expect])) from e
+            return self.scan(inp, token_pos)
         else:
             return None
 
+    def scan(self, inp: str, token_pos: int) -> 'State':
+        """
+        Consumes a token that the expected terminal has already accepted.
+        """
+        try:
+            return self.nextState([inp], self.rule.symbols[self.expect].finish(inp, token_pos, self), (inp, token_pos))
+        except Exception as e:
+            raise Exception('Exception while trying to consume {!r} with {!r}'.format(inp, self.rule.symbols[self.expect])) from e
+
     def consumeNonTerminal(self, inp: Rule) -> Optional['State']:
         assert isinstance(inp, Rule)
         if len(self.rule.symbols) > self.expect \
                 and isinstance(self.rule.symbols[self.expect], RuleRef) \
-                and self.rule.symbols[self.expect].name == inp.name:
-            return self.nextState([], inp.consume(self), ['{!r}: Consume non-terminal {!r}'.format(self.rule.__repr__(self.expect), inp)])
+                and self.rule.symbols[self.expect].id == inp.id:
+            return self.nextState([], inp.consume(self), inp)
         else:
             return None
 
-    def process(self, location, table: List[List['State']], rules: List[Rule], added_rules: List[Rule]) -> None:
+    def consumeCompleted(self, completed: 'State') -> Optional['State']:
+        next_state = self.consumeNonTerminal(completed.rule)
+        if next_state is not None:
+            next_state.data[-1] = completed.data
+            next_state.inp.append(completed)
+            next_state.child = completed
+        return next_state
+
+    def consumeEmpty(self, rule: Rule, validate: bool = True) -> 'State':
+        copy = self.consumeNonTerminal(rule)
+        copy.data[-1] = rule.finish(self, [], validate)
+        return copy
+
+    def complete(self, validate: bool = True) -> None:
+        self.data = self.rule.finish(self, self.data, validate)
+
+    def pack(self, other: 'State') -> None:
+        """
+        Called when an equivalent state is added to the row this state is in.
+        Plain states carry their own derivation, so the other one is dropped.
+        """
+        pass
+
+    def process(self, location, table: List['Row'], grammar: 'CompiledGrammar', added_rules: Set[int], lookahead: Optional['Lookahead'] = None, validate: bool = True) -> None:
         if self.expect == len(self.rule.symbols):
             # We have a completed rule
-            self.data = self.rule.finish(self, self.data)
-            self.trace.insert(0, 'Finish rule {!r}'.format(self.rule))
+            self.complete(validate)
 
             w = 0
             # We need a while here because the empty rule will modify table[reference] when location == reference
             while w < len(table[self.reference]):
                 state = table[self.reference][w]
-                next_state = state.consumeNonTerminal(self.rule)
+                next_state = state.consumeCompleted(self)
                 if next_state is not None:
-                    next_state.data[-1] = self.data
-                    next_state.inp.append(self)
-                    next_state.trace = self.trace + next_state.trace
                     table[location].append(next_state)
                 w += 1
 
@@ -310,52 +462,554 @@ class State:
                 #     addedRules.splice(i, 1);
                 # }
         else:
-            # in case I missed an older nullable's sweep, update yourself. See
-            # above context for why this makes sense
-            ind = table[location].index(self)
-            for i in range(ind):
-                state = table[location][i]
-                if len(state.rule.symbols) == state.expect and state.reference == location:
-                    raise NotImplementedError("Code should not reach this place because we don't do nullables")
-                    x = self.consumeNonTerminal(state.rule)
-                    if x is not None:
-                        x.data[-1] = state.data
-                        x.trace = state.trace + x.trace
-                        table[location].append(x)
-
             # I'm not done, but I can predict something
             expected_symbol = self.rule.symbols[self.expect]
 
             if isinstance(expected_symbol, RuleRef):
-                for rule in rules:
-                    if rule.name == expected_symbol.name and rule not in added_rules:
-                        # Make a note that you've added it already, and don't need to
-                        # add it again; otherwise left recursive rules are going to go
-                        # into an infinite loop by adding themselves over and over
-                        # again.
-
-                        # If it's the null rule, however, you don't do this because it
-                        # affects the current table row, so you might need it to be
-                        # called again later. Instead, I just insert a copy whose
+                # A nullable nonterminal may already have been completed in
+                # this row, before this state was added. Its completion did
+                # not see this state, so consume it now (Aycock & Horspool).
+                # Nullables further down the row have not been processed yet,
+                # and will find this state themselves when they complete.
+                if expected_symbol.id in grammar.nullable:
+                    ind = table[location].index(self)
+                    for state in table[location].nullables:
+                        if state.rule.id == expected_symbol.id and table[location].index(state) < ind:
+                            x = self.consumeCompleted(state)
+                            if x is not None:
+                                table[location].append(x)
+
+                # Make a note that you've predicted this nonterminal already, and
+                # don't need to add its rules again; otherwise left recursive
+                # rules are going to go into an infinite loop by adding themselves
+                # over and over again.
+                predicted = expected_symbol.id in added_rules
+                added_rules.add(expected_symbol.id)
+
+                for rule in grammar.index.get(expected_symbol.id, ()):
+                    if len(rule.symbols) > 0:
+                        # With a lookahead only predict the rules that could
+                        # start with the next token.
+                        if not predicted and (lookahead is None or grammar.can_start(rule, lookahead, self)):
+                            table[location].append(self.__class__(rule, 0, location))
+                    else:
+                        # If it's the null rule, however, you don't skip it because
+                        # it affects the current table row, so you might need it to
+                        # be called again later. Instead, I just insert a copy whose
                         # state has been advanced one position (since that's all the
                         # null rule means anyway)
-                        if len(rule.symbols) > 0:
-                            added_rules.append(rule)
-                            table[location].append(State(rule, 0, location))
-                        else:
-                            # Empty rule, this is special
-                            copy = self.consumeNonTerminal(rule)
-                            copy.data[-1] = rule.finish(self, [])
-                            table[location].append(copy)
+                        table[location].append(self.consumeEmpty(rule, validate))
+
+
+class PackedState(State):
+    """
+    A state as a node in a shared packed parse forest. Instead of copies of
+    everything it consumed, it keeps back-pointers: for every way it was
+    reached, the state it was advanced from and what that state consumed (a
+    (token, position) tuple, a completed PackedState, or an empty Rule). States
+    that only differ in how they were derived are packed into a single node,
+    so ambiguity no longer multiplies the chart.
+
+    Rule callbacks are not run while parsing. values() runs them per
+    derivation, only for the derivations that are actually asked for.
+    """
+
+    __slots__ = ('families',)
+
+    def __init__(self, rule: Rule, expect: int, reference: int) -> None:
+        super().__init__(rule, expect, reference)
+        self.families = []  # type: List[Tuple[PackedState, Any]]
+
+    def __repr__(self) -> str:
+        return "{rule}, from: {ref} ({n} derivations)".format(rule=self.rule.__repr__(self.expect), ref=self.reference, n=len(self.families))
+
+    @property
+    def key(self):
+        return (self.rule.signature, self.expect, self.reference)
+
+    def advance(self, child) -> 'PackedState':
+        state = PackedState(self.rule, self.expect + 1, self.reference)
+        state.families.append((self, child))
+        return state
+
+    def consumeTerminal(self, inp: str, token_pos: int) -> Optional['PackedState']:
+        if len(self.rule.symbols) > self.expect and self.rule.symbols[self.expect].test(inp, token_pos, self):
+            return self.advance((inp, token_pos))
+        else:
+            return None
+
+    def scan(self, inp: str, token_pos: int) -> 'PackedState':
+        return self.advance((inp, token_pos))
+
+    def consumeCompleted(self, completed: 'PackedState') -> Optional['PackedState']:
+        if len(self.rule.symbols) > self.expect \
+                and isinstance(self.rule.symbols[self.expect], RuleRef) \
+                and self.rule.symbols[self.expect].id == completed.rule.id:
+            return self.advance(completed)
+        else:
+            return None
+
+    def consumeEmpty(self, rule: Rule, validate: bool = True) -> 'PackedState':
+        return self.advance(rule)
+
+    def completeDeterministically(self, location: int, table: List['Row']) -> bool:
+        """
+        Leo's optimisation for right recursion: if completing this state can
+        only lead to one chain of completions (see Row.leo), add the state at
+        the top of that chain right away and skip the ones in between. Returns
+        whether it did.
+        """
+        if self.expect != len(self.rule.symbols) or self.reference == location:
+            return False
+        path = table[self.reference].leo(self.rule.id, table)
+        if path is None:
+            return False
+        child = self if path.above is None else DeterministicReduction(path, self)
+        table[location].append(path.top.advance(child))
+        return True
+
+    def complete(self, validate: bool = True) -> None:
+        pass
+
+    def pack(self, other: 'PackedState') -> None:
+        for previous, child in other.families:
+            if not any(previous is p and child is c for p, c in self.families):
+                self.families.append((previous, child))
+
+    def prefixes(self, memo: Optional[Dict[int, List[Any]]] = None, validate: bool = True) -> Iterator[Tuple[List[Any], List[Any], List[str]]]:
+        """
+        Yields (data, tree nodes, trace) for every derivation of the symbols
+        before the dot. The trace is a list of (state, child) steps, see
+        describe().
+        """
+        if self.expect == 0:
+            yield [], [], []
+            return
+
+        for previous, child in self.families:
+            for data, nodes, trace in previous.prefixes(memo, validate):
+                for value, child_nodes, child_trace in previous.expand(child, memo, validate):
+                    yield data + [value], nodes + child_nodes, trace + child_trace
+
+    def expand(self, child, memo: Optional[Dict[int, List[Any]]] = None, validate: bool = True) -> Iterator[Tuple[Any, List[Any], List[str]]]:
+        """
+        Yields (value, tree nodes, trace) for every way this state could have
+        consumed the child, i.e. the symbol after its dot.
+        """
+        symbol = self.rule.symbols[self.expect]
+        if isinstance(child, DeterministicReduction):
+            child = child.resolve()
+        if isinstance(child, PackedState):
+            for value, tree, trace in child.values(memo, validate):
+                yield value, [tree], [(self, child)] + trace
+        elif isinstance(child, Rule):
+            try:
+                value = child.finish(self, [], validate)
+            except Continue:
+                return
+            yield value, [], [(self, child)]
+        else:
+            inp, token_pos = child
+            try:
+                value = symbol.finish(inp, token_pos, self)
+            except Exception as e:
+                raise Exception('Exception while trying to consume {!r} with {!r}'.format(inp, symbol)) from e
+            yield value, [{'label': inp}], [(self, child)]
+
+    @staticmethod
+    def describe(trace: List[Tuple['PackedState', Any]]) -> List[str]:
+        """
+        Formats the (state, child) steps of a derivation like the trace of a
+        plain State. A child of None stands for finishing the state's rule.
+        """
+        return [state.step(child) if child is not None else 'Finish rule {!r}'.format(state.rule)
+            for state, child in trace]
+
+    def values(self, memo: Optional[Dict[int, List[Any]]] = None, validate: bool = True) -> Iterator[Tuple[Any, Any, List[str]]]:
+        """
+        Iterates (data, tree, trace) for every derivation of this completed
+        state, running the rule's callback for each of them. Derivations for
+        which a callback raises Continue are skipped.
+
+        Without memo every call runs the callbacks again. With a memo dict the
+        results are remembered per state, so that each callback runs only once
+        for each derivation, however many parses share it.
+
+        With validate=False the rules' validate() checks are skipped.
+        """
+        if memo is None:
+            return self.evaluate(memo, validate)
+        if id(self) not in memo:
+            memo[id(self)] = list(self.evaluate(memo, validate))
+        return iter(memo[id(self)])
+
+    def evaluate(self, memo: Optional[Dict[int, List[Any]]], validate: bool = True) -> Iterator[Tuple[Any, Any, List[str]]]:
+        assert self.expect == len(self.rule.symbols)
+        for data, nodes, trace in self.prefixes(memo, validate):
+            try:
+                value = self.rule.finish(self, data, validate)
+            except Continue:
+                continue
+            tree = {
+                'label': self.rule.name,
+                'tooltip': self.rule.tooltip,
+                'nodes': nodes
+            }
+            yield value, tree, trace + [(self, None)]
+
+
+class DeterministicPath:
+    """
+    A Leo item. The state is the only one in its row that expects a certain
+    nonterminal, and that nonterminal is the last symbol of its rule. So when
+    the nonterminal is completed, it can only lead to this state being
+    completed, and in turn to the state above it being completed, and so on
+    up to the top of the path.
+    """
+
+    __slots__ = ('state', 'above', 'top')
+
+    def __init__(self, state: PackedState, above: Optional['DeterministicPath']) -> None:
+        self.state = state
+        self.above = above
+        self.top = above.top if above is not None else state
+
+
+class DeterministicReduction:
+    """
+    Stands in for the completed states that a DeterministicPath skipped, from
+    the one that consumes `completed` up to the one just below the top of the
+    path. They are only built when the forest is read.
+    """
+
+    __slots__ = ('path', 'completed', 'state')
+
+    def __init__(self, path: DeterministicPath, completed: PackedState) -> None:
+        self.path = path
+        self.completed = completed
+        self.state = None  # type: Optional[PackedState]
+
+    def resolve(self) -> PackedState:
+        if self.state is None:
+            state, path = self.completed, self.path
+            while path.above is not None:
+                state = path.state.advance(state)
+                path = path.above
+            self.state = state
+        return self.state
+
+
+class Row:
+    """
+    One row of the chart: all states that end at a certain token. It behaves
+    like the list it replaces, except that appending a state that is already
+    in the row (see State.key) is a no-op, and finding the position of a state
+    is a dict lookup instead of a scan.
+
+    The states that wait for a terminal are also grouped by that terminal,
+    so that scanning a token tests every terminal only once: plain Literals
+    are looked up by their string, other symbols are tested once each for
+    all the states waiting for them.
+    """
+
+    def __init__(self, location: int) -> None:
+        self.location = location
+        self.states = []  # type: List[State]
+        self.positions = {}  # type: Dict[Any, int]
+        self.nullables = []  # type: List[State] (completed without consuming any tokens)
+        self.leos = {}  # type: Dict[int, Optional[DeterministicPath]]
+        self.literals = {}  # type: Dict[str, List[int]] (positions of the states waiting for a plain Literal)
+        self.terminals = OrderedDict()  # type: Dict[int, Tuple[Symbol, List[int]]] (same, for other terminals)
+
+    def __repr__(self) -> str:
+        return "Row({}, {!r})".format(self.location, self.states)
+
+    def __len__(self) -> int:
+        return len(self.states)
+
+    def __iter__(self):
+        return iter(self.states)
+
+    def __getitem__(self, index: int) -> State:
+        return self.states[index]
+
+    def __contains__(self, state: State) -> bool:
+        return state.key in self.positions
+
+    def append(self, state: State) -> bool:
+        key = state.key
+        if key in self.positions:
+            self.states[self.positions[key]].pack(state)
+            return False
+        self.positions[key] = len(self.states)
+        self.states.append(state)
+        if state.expect == len(state.rule.symbols):
+            if state.reference == self.location:
+                self.nullables.append(state)
+        else:
+            symbol = state.rule.symbols[state.expect]
+            if isinstance(symbol, RuleRef):
+                pass
+            elif type(symbol).test is Literal.test:
+                self.literals.setdefault(symbol.literal, []).append(self.positions[key])
+            else:
+                self.terminals.setdefault(id(symbol), (symbol, []))[1].append(self.positions[key])
+        return True
+
+    def accepting(self, token: str, position: int, cache: Optional['TestCache'] = None) -> List[State]:
+        """
+        The states in this row whose terminal accepts the token, in the order
+        they were added. Terminals are tested with the first state waiting for
+        them, so they should only look at the token and its position.
+        """
+        matches = list(self.literals.get(token, ()))
+        for symbol, waiting in self.terminals.values():
+            if accepts(symbol, token, position, self.states[waiting[0]], cache):
+                matches.extend(waiting)
+        matches.sort()
+        return [self.states[n] for n in matches]
+
+    def index(self, state: State) -> int:
+        return self.positions[state.key]
+
+    def leo(self, symbol: int, table: List['Row']) -> Optional[DeterministicPath]:
+        """
+        The deterministic path for completing the nonterminal in this row, or
+        None if there is none. Only ask once the row is finished. Paths never
+        continue into row 0, so states completed there are never skipped.
+        """
+        if symbol not in self.leos:
+            # A cycle of rules ends the path here
+            self.leos[symbol] = None
+            waiting = [state for state in self.states
+                if state.expect < len(state.rule.symbols)
+                and isinstance(state.rule.symbols[state.expect], RuleRef)
+                and state.rule.symbols[state.expect].id == symbol]
+            if len(waiting) == 1 and waiting[0].expect == len(waiting[0].rule.symbols) - 1:
+                state = waiting[0]
+                above = table[state.reference].leo(state.rule.id, table) if state.reference > 0 else None
+                self.leos[symbol] = DeterministicPath(state, above)
+        return self.leos[symbol]
+
+
+class CompiledGrammar:
+    """
+    A list of rules prepared for parsing: the rules are grouped by the
+    (interned) nonterminal they produce, and it is worked out once which
+    nonterminals are nullable, i.e. can produce nothing at all, and which
+    terminal symbols each nonterminal can start with (its FIRST set).
+
+    Compiling is not free, so build it once and pass it to every Parser for
+    the same rules instead of the list of rules itself.
+    """
+
+    def __init__(self, rules: List[Rule]) -> None:
+        self.rules = list(rules)
+
+        # Group the rules by the nonterminal they produce, so that predicting
+        # a nonterminal only has to look at the rules that match it. The
+        # order of the rules within each group follows the order of `rules`.
+        self.index = OrderedDict()  # type: Dict[int, List[Rule]]
+        for rule in self.rules:
+            self.index.setdefault(rule.id, []).append(rule)
+
+        self.nullable = set()  # type: Set[int]
+        self.first = {id: set() for id in self.index}  # type: Dict[int, Set[Symbol]]
+
+        # Both grow monotonically, so keep going until neither changes.
+        changed = True
+        while changed:
+            changed = False
+            for rule in self.rules:
+                first = self.first[rule.id]
+                size = len(first)
+                for symbol in rule.symbols:
+                    if isinstance(symbol, RuleRef):
+                        first.update(self.first.get(symbol.id, ()))
+                        if symbol.id not in self.nullable:
+                            break
+                    else:
+                        first.add(symbol)
+                        break
+                else:
+                    if rule.id not in self.nullable:
+                        self.nullable.add(rule.id)
+                        changed = True
+                if len(first) != size:
+                    changed = True
+
+        # For each rule the terminals it can start with, or None if it is
+        # nullable itself and could therefore be followed by anything.
+        self.starts = {}  # type: Dict[int, Optional[List[Symbol]]]
+        for rule in self.rules:
+            starts = set()  # type: Set[Symbol]
+            for symbol in rule.symbols:
+                if isinstance(symbol, RuleRef):
+                    starts.update(self.first.get(symbol.id, ()))
+                    if symbol.id not in self.nullable:
+                        break
+                else:
+                    starts.add(symbol)
+                    break
+            else:
+                starts = None
+            self.starts[id(rule)] = list(starts) if starts is not None else None
+
+    def __repr__(self) -> str:
+        return "CompiledGrammar({} rules, {} nonterminals, {} nullable)".format(len(self.rules), len(self.index), len(self.nullable))
+
+    def rules_for(self, name: str) -> List[Rule]:
+        return self.index.get(symbol_ids.get(name), [])
+
+    def can_start(self, rule: Rule, lookahead: 'Lookahead', state: State) -> bool:
+        """
+        Whether the rule could match the upcoming token. The terminals are
+        tested with the state that predicts the rule, as the state that would
+        scan the token does not exist yet.
+        """
+        starts = self.starts[id(rule)]
+        return starts is None or any(lookahead.test(symbol, state) for symbol in starts)
+
+
+class Lookahead:
+    """
+    The next token while a row is being predicted, and which terminals have
+    already been tested against it, as many rules start with the same ones.
+    """
+
+    __slots__ = ('token', 'position', 'tested', 'cache')
+
+    def __init__(self, token: str, position: int, cache: Optional['TestCache'] = None) -> None:
+        self.token = token
+        self.position = position
+        self.tested = {}  # type: Dict[int, bool]
+        self.cache = cache
+
+    def test(self, symbol: Symbol, state: State) -> bool:
+        try:
+            return self.tested[id(symbol)]
+        except KeyError:
+            result = self.tested[id(symbol)] = accepts(symbol, self.token, self.position, state, self.cache)
+            return result
+
+
+class TestCache:
+    """
+    Remembers the outcomes of Symbol.test(), keyed on the symbol and its
+    test_key() for the token, and counts how often it could answer. Without a
+    maxsize it keeps everything, which is fine for a single parse. With a
+    maxsize it forgets the least recently used outcomes, which makes it fit
+    to share between parses. It can be used from several threads at once.
+    """
+
+    def __init__(self, maxsize: Optional[int] = None) -> None:
+        self.maxsize = maxsize
+        self.outcomes = OrderedDict()  # type: Dict[Tuple[Symbol, Any], bool]
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return "TestCache({} outcomes, {} hits, {} misses)".format(len(self.outcomes), self.hits, self.misses)
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / (self.hits + self.misses) if self.hits + self.misses > 0 else 0.0
+
+    def test(self, symbol: Symbol, literal: str, position: int, state: State) -> bool:
+        key = (symbol, symbol.test_key(literal, position))
+        with self.lock:
+            if key in self.outcomes:
+                self.hits += 1
+                if self.maxsize is not None:
+                    self.outcomes.move_to_end(key)
+                return self.outcomes[key]
+            self.misses += 1
+        outcome = bool(symbol.test(literal, position, state))
+        with self.lock:
+            self.outcomes[key] = outcome
+            if self.maxsize is not None and len(self.outcomes) > self.maxsize:
+                self.outcomes.popitem(last=False)
+        return outcome
+
+
+def accepts(symbol: Symbol, literal: str, position: int, state: State, cache: Optional[TestCache] = None) -> bool:
+    return cache.test(symbol, literal, position, state) if cache is not None else symbol.test(literal, position, state)
 
 
 class Parser:
+    """
+    Earley parser. By default every chart state carries the result of the
+    rule callbacks for its own derivation, and parse() returns a list with
+    all parses.
+
+    With lazy=True parsing happens in two phases: first the input is only
+    recognised, and then the callbacks are run for the states that are part
+    of a complete parse, once per derivation. States that turned out to be a
+    dead end never have their callbacks run. parse() still returns a list.
+
+    With sppf=True the chart is a shared packed parse forest, and parse()
+    returns an iterator that runs the callbacks only for the parses that are
+    taken from it.
+
+    With lookahead=True a rule is only predicted when it can start with the
+    next token (see CompiledGrammar.can_start), which keeps the chart free of
+    states that would never scan anything. This assumes Symbol.test() only
+    looks at the token and its position.
+
+    The packed forest modes (sppf=True or lazy=True) complete right
+    recursion in linear time using Leo's deterministic reduction paths,
+    unless leo=False. The default mode does not, and leo is ignored there:
+    its states run their callbacks and validation as soon as they are
+    completed, so the completions in between that Leo skips are exactly the
+    ones it needs, and right recursion stays quadratic. Use sppf=True for
+    long right-recursive input.
+
+    With cache_tests=True the outcomes of the terminal tests are remembered
+    for the duration of a parse, see TestCache. Pass a TestCache instead to
+    share them between parses. test_stats tells how well the cache did.
+
+    With defer_validation=True the rules' validate() checks are not run on
+    every completed state, but only once for each parse, by the start rule
+    that produced it. This saves checking the many partial results that
+    never become part of a parse.
+
+    With numbering=True the callbacks draw the ids of the objects they create
+    from a Numbering of their own, see datastructures.numbering(), so they
+    are small and do not depend on parses in other threads. Pass a Numbering
+    instead to continue one. With sppf=True this also holds while the parses
+    are taken from the iterator.
+
+    With a Budget the parser stops with BudgetExceeded once it has used it
+    up. Every state in the chart counts as a state and a step when it is
+    processed, every scan as a step, and with sppf=True or lazy=True every
+    parse that is built from the chart as a step too. The budget is spent by
+    all parses of the parser until it is given another one.
+
+    With trace=False the parses come without the 'trace' log of the steps
+    that led to them. Nothing is recorded while parsing either way, the
+    traces are reconstructed afterwards from the back-pointers in the chart.
+    """
+
     FAIL = {}  # type: Any
 
-    def __init__(self, rules: List[Rule], start: str) -> None:
-        self.rules = rules
+    def __init__(self, rules: Union[List[Rule], CompiledGrammar], start: str, sppf: bool = False, lazy: bool = False, trace: bool = True, lookahead: bool = False, leo: bool = True, cache_tests: Union[bool, TestCache] = False, defer_validation: bool = False, numbering: Union[bool, Numbering] = False, budget: Optional[Budget] = None) -> None:
+        self.grammar = rules if isinstance(rules, CompiledGrammar) else CompiledGrammar(rules)
+        self.rules = self.grammar.rules
         self.start = start
-        self.table = []  # type: List[List[State]] (first index is token, second index is possible state)
+        self.sppf = sppf
+        self.lazy = lazy
+        self.trace = trace
+        self.lookahead = lookahead
+        self.state_class = PackedState if sppf or lazy else State
+        self.leo = leo and self.state_class is PackedState
+        self.cache_tests = cache_tests
+        self.defer_validation = defer_validation
+        self.numbering = numbering
+        self.budget = budget
+        self.test_cache = None  # type: Optional[TestCache]
+        self.ids = None  # type: Optional[Numbering]
+        self.table = []  # type: List[Row] (first index is token, second index is possible state)
         self.results = []  # type: List[Any]
         self.current = 0
         self.reset()
@@ -365,88 +1019,163 @@ class Parser:
         table = ["{}: {}".format(n, "\n   ".join(map(repr, level))) for n, level in enumerate(self.table)]
         return "Rules:\n{}\nTable:\n{}\n".format("\n".join(rules), "\n".join(table))
 
-    def reset(self) -> None:
+    def reset(self, lookahead: Optional[Lookahead] = None) -> None:
         # Clear previous work
         self.results = []
         self.current = 0
+        self.test_cache = TestCache() if self.cache_tests is True else self.cache_tests or None
+        self.ids = Numbering() if self.numbering is True else self.numbering or None
+        if lookahead is not None:
+            lookahead.cache = self.test_cache
 
         # Setup a table
-        added_rules = []
-        self.table = [[]]
+        added_rules = {intern_symbol(self.start)}  # type: Set[int]
+        self.table = [Row(0)]
 
         # Prepare the table with all rules that match the start name
-        for rule in self.rules:
-            if rule.name == self.start:
-                added_rules.append(rule)
-                self.table[0].append(State(rule, 0, 0))
-        self.advanceTo(0, added_rules)
-
-    def advanceTo(self, position: int, added_rules: List[Rule]) -> None:
+        for rule in self.grammar.rules_for(self.start):
+            self.table[0].append(self.state_class(rule, 0, 0))
+        with self.numbered():
+            self.advanceTo(0, added_rules, lookahead)
+
+    def numbered(self) -> ContextManager:
+        """
+        The numbering() to run callbacks in, or a block that does nothing if
+        the parser has no Numbering.
+        """
+        return numbering(self.ids) if self.ids is not None else contextlib.ExitStack()
+
+    def advanceTo(self, position: int, added_rules: Set[int], lookahead: Optional[Lookahead] = None) -> None:
         w = 0
         while w < len(self.table[position]):
+            state = self.table[position][w]
+            if self.budget is not None:
+                self.budget.spend(states=1)
             try:
-                self.table[position][w].process(position, self.table, self.rules, added_rules)
+                if not (self.leo and state.completeDeterministically(position, self.table)):
+                    state.process(position, self.table, self.grammar, added_rules, lookahead, not self.defer_validation)
             except Continue:
                 pass
             w += 1
 
     def feed(self, chunk) -> None:
-        for token_pos, token in enumerate(chunk):
-            # We add anew states to table[current + 1]
-            self.table.append([])
-
-            # Advance all tokens that expect the symbol
-            # So for each state in the previous row,
-
-            w = 0
-            while w < len(self.table[self.current + token_pos]):
-                current_state = self.table[self.current + token_pos][w]
-                next_state = current_state.consumeTerminal(token, token_pos)
-                if next_state is not None:
-                    self.table[self.current + token_pos + 1].append(next_state)
-                w += 1
-
-            # Are there duplicates?
-            t = self.table[self.current + token_pos + 1] 
-            for i, left in enumerate(t):
-                for right in t[i+1:]:
-                    if left == right:
-                        t[i] = None
-                        break
-            self.table[self.current + token_pos + 1] = list(filter(lambda s: s is not None, t))
-
-            # Next, for each of the rules, we either
-            # (a) complete it, and try to see if the reference row expected that rule
-            # (b) predict the next nonterminal it expects by adding that nonterminal's stat state
-            # To prevent duplication, we also keep track of rules we have already added.
-
-            added_rules = []  # type: List[Rule]
-            self.advanceTo(self.current + token_pos + 1, added_rules)
-
-            # If needed, throw an error
-            if len(self.table[-1]) == 0:
-                # No states at all! This is not good
-                # print(self.table)
-                raise ParseError(self.current + token_pos, token, sentence=chunk,
-                    expected=[str(state.rule.symbols[state.expect] \
-                        if len(state.rule.symbols) < state.expect \
-                        else "{}".format(state.rule)) for state in self.table[-2]])
-
-        self.current += len(chunk)
-
-        # Incrementally keep track of results
-        self.results = self.finish()
+        with self.numbered():
+            for token_pos, token in enumerate(chunk):
+                # We add anew states to table[current + 1]. Duplicates are dropped
+                # by the row itself.
+                self.table.append(Row(self.current + token_pos + 1))
+
+                # Advance all states in the previous row that expect a terminal
+                # that accepts the token
+                for current_state in self.table[self.current + token_pos].accepting(token, token_pos, self.test_cache):
+                    if self.budget is not None:
+                        self.budget.spend()
+                    self.table[self.current + token_pos + 1].append(current_state.scan(token, token_pos))
+
+                # Next, for each of the rules, we either
+                # (a) complete it, and try to see if the reference row expected that rule
+                # (b) predict the next nonterminal it expects by adding that nonterminal's stat state
+                # To prevent duplication, we also keep track of rules we have already added.
+
+                added_rules = set()  # type: Set[int]
+                lookahead = Lookahead(chunk[token_pos + 1], token_pos + 1, self.test_cache) if self.lookahead and token_pos + 1 < len(chunk) else None
+                self.advanceTo(self.current + token_pos + 1, added_rules, lookahead)
+
+                # If needed, throw an error
+                if len(self.table[-1]) == 0:
+                    # No states at all! This is not good
+                    # print(self.table)
+                    raise ParseError(self.current + token_pos, token, sentence=chunk,
+                        expected=[str(state.rule.symbols[state.expect] \
+                            if len(state.rule.symbols) < state.expect \
+                            else "{}".format(state.rule)) for state in self.table[-2]])
+
+            self.current += len(chunk)
+
+            # Incrementally keep track of results
+            self.results = self.finish()
 
     def finish(self) -> List[List[Any]]:
         # Return the possible parsings
-        return [dict(data=state.data, trace=list(reversed(state.trace)), tree=state.tree) for state in self.table[-1] if
+        if self.sppf:
+            derivations = self.budgeted(self.derivations())
+            return derivations if self.ids is None else numbered(self.ids, derivations)
+
+        if self.lazy:
+            return list(self.budgeted(self.derivations(memo=dict())))
+
+        return [self.result(self.validated(state, state.data), state.tree, lambda: state.trace) for state in self.table[-1] if
                 state.rule.name == self.start
                 and state.expect == len(state.rule.symbols)
                 and state.reference == 0
                 and state.data is not self.FAIL]
 
+    def derivations(self, memo: Optional[Dict[int, List[Any]]] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Lazily yields the parses in the forest. Each one is built, callbacks
+        and all, only when it is taken from the iterator. See
+        PackedState.values() for memo.
+        """
+        completed = [state for state in self.table[-1] if
+                state.rule.name == self.start
+                and state.expect == len(state.rule.symbols)
+                and state.reference == 0]
+
+        return (self.result(self.validated(state, data), tree, lambda: PackedState.describe(trace))
+            for state in completed
+            for data, tree, trace in state.values(memo, not self.defer_validation)
+            if data is not self.FAIL)
+
+    def budgeted(self, parses: Iterator[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        """
+        Spends a step of the budget before each parse is built, if there is
+        a budget.
+        """
+        if self.budget is None:
+            return parses
+        return self._budgeted(self.budget, parses)
+
+    @staticmethod
+    def _budgeted(budget: Budget, parses: Iterator[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        parses = iter(parses)
+        while True:
+            budget.spend()
+            try:
+                parse = next(parses)
+            except StopIteration:
+                return
+            yield parse
+
+    def validated(self, state: State, data: Any) -> Any:
+        """
+        Runs the validation that was skipped while parsing, if it was, on a
+        complete parse.
+        """
+        if not self.defer_validation:
+            return data
+        try:
+            return state.rule.validate(data)
+        except Exception as e:
+            raise Exception('Error while trying to validate a parse of the rule {!r}'.format(state.rule)) from e
+
+    @property
+    def test_stats(self) -> Optional[Dict[str, Any]]:
+        """
+        Hits, misses and hit rate of the terminal test cache, if there is one.
+        For a shared cache these count all parses that used it.
+        """
+        if self.test_cache is None:
+            return None
+        return dict(hits=self.test_cache.hits, misses=self.test_cache.misses, hit_rate=self.test_cache.hit_rate)
+
+    def result(self, data: Any, tree: Any, trace: Callable[[], List[str]]) -> Dict[str, Any]:
+        if self.trace:
+            return dict(data=data, trace=trace(), tree=tree)
+        else:
+            return dict(data=data, tree=tree)
+
     def parse(self, chunk: List[str]) -> List[State]:
-        self.reset()
+        self.reset(Lookahead(chunk[0], 0) if self.lookahead and len(chunk) > 0 else None)
         self.feed(chunk)
         return self.results
 
@@ -582,6 +1311,36 @@ if __name__ == '__main__':
         ], 'A')
         print(p.parse(list('A1234')))
 
+    def test_ambiguity_sppf():
+        """Test that the packed forest yields the same parses, lazily"""
+        rules = [
+            Rule('A', [RuleRef('A'), RuleRef('A')]),
+            Rule('A', [Literal('a')]),
+        ]
+        eager = Parser(rules, 'A').parse(list('aaaaa'))
+        lazy = Parser(rules, 'A', sppf=True).parse(list('aaaaa'))
+        first = next(lazy)
+        assert len(eager) == 1 + len(list(lazy)) == 14
+        assert any(repr(first['data']) == repr(parse['data']) for parse in eager)
+        print(first)
+
+    def test_lookahead():
+        """Test that lookahead leaves out predictions, but not parses"""
+        rules = CompiledGrammar([
+            Rule('S', [RuleRef('A'), RuleRef('B')]),
+            Rule('A', [Literal('a')]),
+            Rule('A', [Digit(), RuleRef('A')]),
+            Rule('B', [RuleRef('A')]),
+            Rule('B', [Alpha(), Literal('b')]),
+            Rule('B', []),
+        ])
+        for sentence in ('a', '1a', '12ab', 'axb'):
+            plain = Parser(rules, 'S')
+            filtered = Parser(rules, 'S', lookahead=True)
+            assert repr(plain.parse(list(sentence))) == repr(filtered.parse(list(sentence)))
+            assert sum(map(len, filtered.table)) < sum(map(len, plain.table))
+        print(filtered.parse(list('axb')))
+
     def test_empty_rule():
         """Test recursion and the empty rule"""
         p = Parser([
@@ -591,6 +1350,148 @@ if __name__ == '__main__':
         ], 'START')
         print(p.parse(list('AAABBB')))
 
+    def test_nullable():
+        """Test a nonterminal that is nullable without having an empty rule itself"""
+        grammar = CompiledGrammar([
+            Rule('S', [Literal('a'), RuleRef('N'), RuleRef('N'), Literal('b')]),
+            Rule('N', [RuleRef('E'), RuleRef('E')]),
+            Rule('E', [Literal('e')]),
+            Rule('E', []),
+        ])
+        assert grammar.nullable == {intern_symbol('N'), intern_symbol('E')}
+        assert {repr(symbol) for symbol in grammar.first[intern_symbol('N')]} == {'"e"'}
+        for sppf in (False, True):
+            assert len(list(Parser(grammar, 'S', sppf=sppf).parse(list('ab')))) == 1
+            assert len(list(Parser(grammar, 'S', sppf=sppf).parse(list('aeb')))) > 0
+        print(Parser(grammar, 'S').parse(list('ab')))
+
+    def test_same_rule_other_callback():
+        """Test that rules that read the same but do something else are kept apart"""
+        rules = [
+            Rule('S', [Literal('a')], lambda state, data: 'first'),
+            Rule('S', [Literal('a')], lambda state, data: 'second'),
+        ]
+        for options in ({}, dict(sppf=True), dict(lazy=True)):
+            assert sorted(parse['data'] for parse in Parser(rules, 'S', **options).parse(['a'])) == ['first', 'second']
+
+        # The same, when the callbacks are replaced after the rules are made
+        first = lambda state, data: 'first'
+        replaced = [Rule('S', [Literal('a')], first), Rule('S', [Literal('a')], first)]
+        assert replaced[0].signature == replaced[1].signature
+        replaced[1].callback = lambda state, data: 'second'
+        assert sorted(parse['data'] for parse in Parser(replaced, 'S').parse(['a'])) == ['first', 'second']
+
+        # A callback may close over itself before it is assigned
+        def recursive_rule():
+            rule = Rule('S', [Literal('a')], lambda state, data: callback(state, data))
+            callback = lambda state, data: 'third'
+            return rule
+        assert [parse['data'] for parse in Parser([recursive_rule()], 'S').parse(['a'])] == ['third']
+        print(Parser(rules, 'S').parse(['a']))
+
+    def test_leo():
+        """Test that Leo's reduction paths give the same parses of right recursion, with fewer states"""
+        rules = [
+            Rule('S', [Literal('a'), RuleRef('S')], lambda state, data: [data[0]] + data[1]),
+            Rule('S', [Literal('a')], lambda state, data: [data[0]]),
+        ]
+        for options in (dict(sppf=True), dict(lazy=True)):
+            with_leo = Parser(rules, 'S', leo=True, **options)
+            without_leo = Parser(rules, 'S', leo=False, **options)
+            parses = list(with_leo.parse(list('aaaaaaaa')))
+            assert repr(parses) == repr(list(without_leo.parse(list('aaaaaaaa'))))
+            assert len(parses) == 1 and parses[0]['data'] == list('aaaaaaaa')
+            assert sum(map(len, with_leo.table)) < sum(map(len, without_leo.table))
+        print(parses[0]['data'])
+
+    def test_cache_tests():
+        """Test that cached terminal tests give the same parses, and are shared between parses"""
+        calls = []
+
+        class CountingDigit(Digit):
+            def test(self, literal: str, position: int, state: 'State') -> bool:
+                calls.append(literal)
+                return super().test(literal, position, state)
+
+            def test_key(self, literal: str, position: int) -> Any:
+                return literal
+
+        rules = [
+            Rule('A', [RuleRef('A'), CountingDigit()]),
+            Rule('A', [RuleRef('A'), Literal('+'), CountingDigit()]),
+            Rule('A', [CountingDigit()]),
+        ]
+        plain = Parser(rules, 'A').parse(list('1+1+1'))
+        uncached_calls, calls[:] = len(calls), []
+        cache = TestCache()
+        assert repr(Parser(rules, 'A', cache_tests=cache).parse(list('1+1+1'))) == repr(plain)
+        cached_calls = len(calls)
+        assert cached_calls < uncached_calls
+        p = Parser(rules, 'A', cache_tests=cache)
+        assert repr(p.parse(list('1+1+1'))) == repr(plain)
+        assert len(calls) == cached_calls and p.test_stats['misses'] == cached_calls
+        print(p.test_stats)
+
+    def test_defer_validation():
+        """Test that deferred validation gives the same parses, with fewer checks"""
+        checked = []
+
+        class CheckedRule(Rule):
+            def validate(self, value: Any) -> Any:
+                checked.append(value)
+                return ''.join(value)
+
+        rules = [
+            CheckedRule('S', [RuleRef('A'), RuleRef('A')], lambda state, data: data),
+            Rule('A', [RuleRef('A'), Literal('a')], lambda state, data: data[0] + data[1]),
+            Rule('A', [Literal('a')], lambda state, data: data[0]),
+        ]
+        for options in ({}, dict(sppf=True), dict(lazy=True)):
+            checked[:] = []
+            eager = list(Parser(rules, 'S', **options).parse(list('aaaa')))
+            eager_checks, checked[:] = len(checked), []
+            deferred = list(Parser(rules, 'S', defer_validation=True, **options).parse(list('aaaa')))
+            assert sorted(parse['data'] for parse in eager) == sorted(parse['data'] for parse in deferred) == ['aaaa'] * 3
+            assert len(checked) == 3 <= eager_checks
+        print([parse['data'] for parse in deferred])
+
+    def test_numbering():
+        """Test that ids start at 1 again in a numbering, and in every parse with numbering=True"""
+        from datastructures import Sequence
+        sequence = Sequence()
+        sequence.next()
+        with numbering():
+            assert [sequence.next(), sequence.next()] == [1, 2]
+        assert sequence.next() == 2
+
+        rules = [
+            Rule('A', [RuleRef('A'), Literal('a')], lambda state, data: data[0] + [sequence.next()]),
+            Rule('A', [Literal('a')], lambda state, data: [sequence.next()]),
+        ]
+        for options in ({}, dict(sppf=True)):
+            first = [parse['data'] for parse in Parser(rules, 'A', numbering=True, **options).parse(list('aaa'))]
+            second = [parse['data'] for parse in Parser(rules, 'A', numbering=True, **options).parse(list('aaa'))]
+            assert first == second == [[1, 2, 3]]
+        print(first)
+
+    def test_budget():
+        """Test that a parse stops once it runs out of its budget"""
+        rules = [
+            Rule('A', [RuleRef('A'), RuleRef('A')]),
+            Rule('A', [Literal('a')]),
+        ]
+        assert len(Parser(rules, 'A', budget=Budget()).parse(list('aaaa'))) == 5
+        for limits in (dict(max_steps=10), dict(max_states=10), dict(seconds=0)):
+            for options in ({}, dict(sppf=True)):
+                try:
+                    list(Parser(rules, 'A', budget=Budget(**limits), **options).parse(list('aaaa')))
+                    assert False, 'BudgetExceeded not raised'
+                except BudgetExceeded as error:
+                    limit, value = next(iter(limits.items()))
+                    assert 'max_' + error.limit == limit or error.limit == limit
+                    assert error.limit == 'seconds' or error.stats[error.limit] == value + 1
+                    print(error)
+
     if len(sys.argv) > 1:
         tests = [globals()[arg] for arg in sys.argv[1:]]
     else: